@@ -1,16 +1,14 @@
 import streamlit as st
 from dotenv import load_dotenv
-import google.generativeai as genai
 import os
-import pymupdf4llm
-import fitz  # PyMuPDF
-from PIL import Image
-import io
-import gc
-from streamlit_mermaid import st_mermaid
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from gemini_utils import (
     analyze_with_gemini,
     summarize_text,
+    summarize_section,
     generate_mermaid_req_doc,
     generate_trd_content,
     generate_epics_and_user_stories
@@ -18,68 +16,59 @@ from gemini_utils import (
 from docx_utils import create_trd_word_document
 from prompts import GEMINI_MODEL
 from analysis_utils import count_epics_and_stories
-
-load_dotenv(override=True)
+from extraction_utils import extract_pdf_content, InvalidPageRangeError
+from compression_utils import (
+    COMPRESSION_RULES,
+    DEFAULT_COMPRESSION_RULES,
+    find_repeated_lines,
+    find_page_edge_lines,
+    compress_markdown
+)
+from retrieval_utils import chunk_document, build_index, select_chunks, format_chunks
+from revision_utils import hash_file, build_fingerprint, diff_fingerprints, find_previous_version, group_sections
+from ui_utils import inject_css, render_mermaid
+from budget_utils import (
+    BUDGET_SESSION_TOKENS,
+    BUDGET_MONTHLY_TOKENS,
+    estimate_request,
+    estimate_cost,
+    combine_estimates,
+    format_estimate,
+    check_budget,
+    get_usage_ledger
+)
 
 st.set_page_config(
     page_title="BA Agent",
     page_icon="📄"
 )
 
-st.title("📄 Business Analysis Agent")
-st.markdown(f"Powered by Google's **{GEMINI_MODEL}**")
 
-# Custom CSS to reduce vertical spacing for a more compact layout
-st.markdown("""
-<style>
-    /* Main container adjustments */
-    .main .block-container {
-        padding-top: 2rem; /* A bit of space at the top */
-    }
+@st.cache_resource(show_spinner=False)
+def load_environment():
+    """Loads the .env file once per process instead of on every rerun."""
+    load_dotenv(override=True)
 
-    /* Heading adjustments for compactness */
-    h1 {
-        margin-bottom: 0.5rem !important; /* Space after main title */
-    }
-    h2, h3 { /* Affects st.subheader and st.header */
-        margin-top: 2rem !important; /* Space before section headers */
-    }
 
-    /* Sidebar adjustments for compactness */
-    [data-testid="stSidebar"] div.stMarkdown {
-        padding-top: 0px !important;
-        padding-bottom: 0px !important;
-    }
-    [data-testid="stSidebar"] ul {
-        list-style-type: none;
-        padding-left: 0;
-    }
-    [data-testid="stSidebar"] h2 {
-        margin-top: 1rem; /* Space above section headers */
-        margin-bottom: 0.25rem; /* Reduce space after sidebar headers */
-    }
-    /* Custom style for the token display in the sidebar */
-    .sidebar-token-usage {
-        font-size: 0.9rem;
-        color: grey;
-        padding: 0px;
-        margin-bottom: 0.5rem; /* Reduced bottom margin */
-    }
-</style>
-""", unsafe_allow_html=True)
+load_environment()
+
+st.title("📄 Business Analysis Agent")
+st.markdown(f"Powered by Google's **{GEMINI_MODEL}**")
+
+inject_css()
 
 gemini_api_key = os.getenv("GOOGLE_API_KEY")
 if not gemini_api_key or gemini_api_key.strip() == "":
     st.error("GOOGLE_API_KEY environment variable not found.")
     st.stop()
 
-genai.configure(api_key=gemini_api_key)
-
 # --- App Logic with Session State ---
 
 # Initialize session state
 if "files" not in st.session_state:
     st.session_state.files = {}  # Dictionary to hold data for each file
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex[:12]  # identifies the session in the usage ledger
 if "token_counts" not in st.session_state:
     st.session_state.token_counts = {"prompt": 0, "output": 0, "total": 0}
 if "global_analysis" not in st.session_state:
@@ -92,56 +81,401 @@ if "global_analysis" not in st.session_state:
         "use_summary": False
     }
 
+# The three pieces of a TRD with their label, retrieval prompt type and
+# generator. They are stored independently so a failed piece can be retried
+# without regenerating the others.
+TRD_PARTS = {
+    "mermaid_code": ("System architecture diagram", "mermaid", generate_mermaid_req_doc),
+    "trd_content": ("TRD content", "trd", generate_trd_content),
+    "epics_user_stories": ("Epics and user stories", "epics", generate_epics_and_user_stories),
+}
+
+CONTEXT_MODES = ["Relevant sections", "Full document"]
+DEFAULT_CONTEXT_TOKEN_BUDGET = 12000
+DEFAULT_CONTEXT_TOP_K = 20
+
+
+def record_usage(token_info, prompt_type, file_hash=None):
+    """Adds the tokens of a Gemini request to the session's counters and the usage ledger."""
+    st.session_state.token_counts["prompt"] += token_info["prompt"]
+    st.session_state.token_counts["output"] += token_info["output"]
+    st.session_state.token_counts["total"] += token_info["total"]
+    get_usage_ledger().record(prompt_type, token_info, file_hash, st.session_state.session_id)
+
+
+def estimate_input(prompt_type, input_text, images):
+    """
+    Estimates the tokens and cost of sending the given text and images for a
+    prompt type, using the average response length recorded in the ledger.
+    """
+    # Images are the blobs stored with each file, so their sizes are looked up by identity
+    sizes = {
+        id(image): size for data in st.session_state.files.values()
+        for image, size in zip(data["image_list"], data["image_sizes"])
+    }
+    image_sizes = [sizes.get(id(image), (768, 768)) for image in images]
+    return estimate_request(prompt_type, input_text, image_sizes, get_usage_ledger().average_output_tokens(prompt_type))
+
+
+def within_budget(estimate):
+    """
+    Checks an action's estimate against the token budgets before it runs.
+
+    Returns:
+        bool: False if the action would exceed a budget that is enforced as a
+              hard stop, in which case an error is shown instead.
+    """
+    ledger = get_usage_ledger()
+    # Other replicas may have used tokens since the last read
+    ledger.refresh()
+    level, message = check_budget(estimate, st.session_state.token_counts["total"], ledger.current_month_tokens())
+    if level == "stop":
+        st.error(f"{message} The action was not run.")
+        return False
+    if level == "warn":
+        # A toast, because the page reruns once the action is done
+        st.toast(message)
+    return True
+
+
+def images_for_chunks(file_data, chunks):
+    """Returns the images of a file that are on the pages spanned by the given chunks."""
+    return [
+        image for image, page in zip(file_data["image_list"], file_data["image_pages"])
+        if any(first_page <= page <= last_page for first_page, last_page in (chunk["pages"] for chunk in chunks))
+    ]
+
+
+def select_context(index, prompt_type):
+    """Selects the chunks of an index to send for a prompt type under the sidebar's token budget."""
+    return select_chunks(
+        index,
+        prompt_type,
+        st.session_state.get("context_token_budget", DEFAULT_CONTEXT_TOKEN_BUDGET),
+        st.session_state.get("context_top_k", DEFAULT_CONTEXT_TOP_K),
+    )
+
+
+def file_prompt_input(file_data, prompt_type):
+    """
+    Returns the text and images to send to Gemini for a prompt about one file.
+
+    The summary is used if selected. Otherwise either the whole compressed
+    document or only its sections most relevant to the prompt type are sent,
+    depending on the context mode chosen in the sidebar.
+    """
+    if file_data.get("use_summary", False) and file_data["summary"]:
+        return file_data["summary"], []
+    if st.session_state.get("context_mode", CONTEXT_MODES[0]) == "Full document":
+        return file_data["prompt_text"], file_data["image_list"]
+    chunks = select_context(file_data["retrieval_index"], prompt_type)
+    return format_chunks(chunks), images_for_chunks(file_data, chunks)
+
+
+def global_retrieval_index():
+    """Returns a retrieval index over all files, rebuilt only when the files or compression rules change."""
+    key = tuple((name, data["file_hash"], tuple(data["compression_rules"].items())) for name, data in st.session_state.files.items())
+    cached = st.session_state.get("global_retrieval_index")
+    if not cached or cached[0] != key:
+        chunks = [chunk for data in st.session_state.files.values() for chunk in data["retrieval_index"]["chunks"]]
+        cached = (key, build_index(chunks))
+        st.session_state.global_retrieval_index = cached
+    return cached[1]
+
+
+def global_prompt_input(prompt_type, allow_summary=True):
+    """Returns the text and images to send to Gemini for a prompt about all files combined."""
+    global_analysis = st.session_state.global_analysis
+    if allow_summary and global_analysis.get("use_summary", False) and global_analysis["summary"]:
+        return global_analysis["summary"], []
+    files = st.session_state.files
+    if st.session_state.get("context_mode", CONTEXT_MODES[0]) == "Full document":
+        combined_text = "\n\n--- \n\n".join([data["prompt_text"] for data in files.values()])
+        combined_images = [img for data in files.values() for img in data["image_list"]]
+        return combined_text, combined_images
+    chunks = select_context(global_retrieval_index(), prompt_type)
+    images = [
+        img for name, data in files.items()
+        for img in images_for_chunks(data, [chunk for chunk in chunks if chunk["source"] == name])
+    ]
+    return format_chunks(chunks), images
+
+
+def generate_trd_parts(target, input_for):
+    """
+    Generates the TRD pieces that are missing from `target` and stores each one
+    as soon as it succeeds. If the TRD is already complete, all pieces are
+    regenerated and only replace the existing ones once every new piece has
+    succeeded, so a failed call never leaves a TRD that is half old, half new.
+
+    Args:
+        target (dict): The file data or global analysis to store the pieces in.
+        input_for (callable): Returns the text and images to send for a prompt type.
+
+    Returns:
+        bool: True if every requested piece succeeded. On False the page must
+              not rerun, so the error shown stays visible.
+    """
+    regenerate = all(target.get(key) for key in TRD_PARTS)
+    results = {}
+
+    for key, (_, prompt_type, generator) in TRD_PARTS.items():
+        if target.get(key) and not regenerate:
+            continue
+        input_text, images_to_analyze = input_for(prompt_type)
+        result, token_info = generator(input_text, images_to_analyze)
+        # A diagram that is still invalid after the repair retry has used tokens too
+        if token_info:
+            record_usage(token_info, prompt_type, target.get("file_hash"))
+        if not (result and token_info):
+            if regenerate:
+                st.warning("The TRD was not regenerated; the previous version is kept.")
+                return False
+            continue
+        results[key] = result
+        if not regenerate:
+            target[key] = result
+
+    if regenerate:
+        target.update(results)
+    return all(target.get(key) for key in TRD_PARTS)
+
+
+def missing_trd_parts(target):
+    """Returns the labels of missing TRD pieces if a TRD was only partially generated."""
+    missing = [label for key, (label, _, _) in TRD_PARTS.items() if not target.get(key)]
+    return missing if len(missing) < len(TRD_PARTS) else []
+
+
+def estimate_trd_parts(target, input_for):
+    """Estimates the requests that generate_trd_parts would send for `target`."""
+    regenerate = all(target.get(key) for key in TRD_PARTS)
+    return combine_estimates(
+        estimate_input(prompt_type, *input_for(prompt_type))
+        for key, (_, prompt_type, _) in TRD_PARTS.items()
+        if regenerate or not target.get(key)
+    )
+
+
+def current_compression_rules():
+    """Returns the prompt compression rules currently selected in the sidebar."""
+    return {rule: st.session_state.get(f"compress_{rule}", enabled) for rule, enabled in DEFAULT_COMPRESSION_RULES.items()}
+
+
+def apply_compression(file_name, file_data, rules):
+    """
+    Stores the compressed prompt text of a file, the tokens saved by
+    compressing it and the retrieval index over its compressed sections.
+    """
+    file_data["prompt_text"], file_data["compression"] = compress_markdown(
+        file_data["md_text"], rules, file_data["repeated_lines"], file_data["page_edge_lines"]
+    )
+    file_data["retrieval_index"] = build_index(chunk_document(
+        file_name, file_data["md_text"], file_data["page_offsets"], rules, file_data["repeated_lines"],
+        file_data["page_numbers"]
+    ))
+    file_data["compression_rules"] = rules
+
+
+# Chunks shorter than this are passed into the summary verbatim instead of
+# spending a Gemini call on them.
+SECTION_SUMMARY_MIN_CHARS = 600
+# Chunk summary requests sent at the same time
+SUMMARY_CONCURRENCY = 4
+
+
+def summary_chunks(file_data):
+    """Returns the (hash, title, text, images) of each chunk that makes up a file's summary."""
+    sections = []
+    for section in file_data["fingerprint"]["sections"]:
+        section_text, _ = compress_markdown(file_data["md_text"][section["start"]:section["end"]],
+                                            file_data["compression_rules"], file_data["repeated_lines"],
+                                            file_data["page_edge_lines"], section["start"])
+        # Sections removed by the compression rules (TOC, appendix) are left out
+        if section_text.strip():
+            sections.append((section["hash"], section["title"], section_text))
+    chunks = [(chunk_hash, title, text, None) for chunk_hash, title, text in group_sections(sections)]
+    if file_data["image_list"]:
+        chunks.append((file_data["images_hash"], "Images", "Images from the business plan.", file_data["image_list"]))
+    return chunks
+
+
+def needs_summary_request(text, images):
+    """Returns whether a summary chunk is sent to Gemini rather than passed into the summary verbatim."""
+    return bool(images) or len(text) >= SECTION_SUMMARY_MIN_CHARS
+
+
+def estimate_summary(file_data):
+    """Estimates the requests generate_summary would send, counting only chunks without a cached summary."""
+    estimates = {}
+    for chunk_hash, _, text, images in summary_chunks(file_data):
+        # Chunks with identical content share one summary
+        if chunk_hash not in file_data["chunk_summaries"] and needs_summary_request(text, images):
+            estimates.setdefault(chunk_hash, estimate_input("section_summary", text, images or []))
+    return combine_estimates(estimates.values())
+
+
+def generate_summary(file_data):
+    """
+    Builds a file's summary from the summaries of its chunks of adjacent sections.
+
+    Chunk summaries are cached by the content hashes of their sections, so
+    after a revision only chunks with new or changed sections (and the
+    images, if they changed) are sent to Gemini. The uncached chunks are
+    summarized concurrently.
+
+    Returns:
+        bool: True if the summary is complete.
+    """
+    chunk_summaries = file_data["chunk_summaries"]
+    chunks = summary_chunks(file_data)
+    requests = {}
+    for chunk_hash, _, text, images in chunks:
+        if chunk_hash in chunk_summaries or chunk_hash in requests:
+            continue
+        if needs_summary_request(text, images):
+            requests[chunk_hash] = (text, images)
+        else:
+            chunk_summaries[chunk_hash] = text.strip()
+
+    # The worker threads report errors on this page, so they get its script context
+    script_run_ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(max_workers=SUMMARY_CONCURRENCY,
+                            initializer=lambda: add_script_run_ctx(threading.current_thread(), script_run_ctx)) as pool:
+        futures = {chunk_hash: pool.submit(summarize_section, text, images) for chunk_hash, (text, images) in requests.items()}
+        # Session state is only updated from this thread
+        for chunk_hash, future in futures.items():
+            summary, token_info = future.result()
+            if token_info:
+                record_usage(token_info, "section_summary", file_data["file_hash"])
+            if summary and token_info:
+                chunk_summaries[chunk_hash] = summary
+
+    if not all(chunk_hash in chunk_summaries for chunk_hash, _, _, _ in chunks):
+        return False
+    file_data["summary"] = "\n\n".join(f"#### {title}\n\n{chunk_summaries[chunk_hash]}" for chunk_hash, title, _, _ in chunks)
+    return True
+
+
+def show_revision_changes(file_data):
+    """Shows which sections and pages changed since the previous version of a file."""
+    changes = file_data.get("changes")
+    if not changes:
+        return
+    changed_count = len(changes["changed"]) + len(changes["added"]) + len(changes["removed"])
+    with st.expander(f"Version {file_data['version']}: {changed_count} section(s) changed since {changes['previous_name']}"):
+        if changes["changed"]:
+            st.markdown("**Changed:** " + ", ".join(changes["changed"]))
+        if changes["added"]:
+            st.markdown("**Added:** " + ", ".join(changes["added"]))
+        if changes["removed"]:
+            st.markdown("**Removed:** " + ", ".join(changes["removed"]))
+        st.markdown(f"**Unchanged:** {len(changes['unchanged'])} section(s). Cached summaries are reused for chunks "
+                    "with no changed sections.")
+        if changes["pages_changed"]:
+            st.markdown("**Pages with new content:** " + ", ".join(str(page) for page in changes["pages_changed"]))
+
 uploaded_files = st.file_uploader("Upload one or more Business Plans in the form of a PDF", type="pdf", accept_multiple_files=True)
 
 # 1. Process uploaded files
 if uploaded_files:
-    for uploaded_file in uploaded_files:
-        # Process only new files that haven't been processed yet
-        if uploaded_file.name not in st.session_state.files:
-            temp_pdf_path = f"temp_{uploaded_file.name}"
-            try:
-                with st.spinner(f"Processing {uploaded_file.name}..."):
-                    # Write to a temporary file to be processed
-                    with open(temp_pdf_path, "wb") as f:
-                        f.write(uploaded_file.getvalue())
-
-                    # Extract markdown text and store in session state
-                    md_text = pymupdf4llm.to_markdown(temp_pdf_path)
-
-                    # Extract images and store in session state
-                    image_list = []
-                    doc = fitz.open(temp_pdf_path)
-                    for page in doc:
-                        images = page.get_images(full=True)
-                        for img_index, img in enumerate(images):
-                            xref = img[0]
-                            base_image = doc.extract_image(xref)
-                            image_bytes = base_image["image"]
-                            image = Image.open(io.BytesIO(image_bytes))
-                            image_list.append(image)
-                    doc.close()
-                    gc.collect()  # Force garbage collection to release file lock
-
-                    # Store extracted data in session state under the file's name
-                    st.session_state.files[uploaded_file.name] = {
-                        "md_text": md_text,
-                        "image_list": image_list,
-                        "summary": None,
-                        "analysis": None,
-                        "mermaid_code": None,
-                        "trd_content": None,
-                        "epics_user_stories": None,
-                        "use_summary": False  # Default to not using summary
+    # The page range from the sidebar applies to every file. Changing it
+    # re-extracts the files already uploaded.
+    page_range = st.session_state.get("page_range", "").strip()
+    # If the same name is uploaded twice, only the most recent upload counts
+    latest_uploads = {uploaded_file.name: uploaded_file for uploaded_file in uploaded_files}
+    for uploaded_file in latest_uploads.values():
+        previous_name = find_previous_version(st.session_state.files, uploaded_file.name, latest_uploads.keys())
+        previous = st.session_state.files.get(previous_name)
+        upload_id = getattr(uploaded_file, "file_id", None)
+        if previous and upload_id and previous.get("upload_id") == upload_id and previous["page_range"] == page_range:
+            continue
+
+        # Process only new files, revisions whose content has changed and
+        # files whose page range has changed
+        file_bytes = uploaded_file.getvalue()
+        file_hash = hash_file(file_bytes)
+        same_content = bool(previous) and previous["file_hash"] == file_hash
+        if same_content and previous["page_range"] == page_range:
+            previous["upload_id"] = upload_id
+            continue
+
+        progress_bar = st.progress(0.0, text=f"Extracting {uploaded_file.name}...")
+        try:
+            # Extract markdown text, page offsets and images, a batch of pages at a time
+            extracted = extract_pdf_content(
+                file_bytes,
+                page_range,
+                progress=lambda done, total: progress_bar.progress(
+                    done / total, text=f"Extracting {uploaded_file.name}: page {done} of {total}"
+                )
+            )
+            with st.spinner(f"Processing {uploaded_file.name}..."):
+                repeated_lines = find_repeated_lines(extracted["md_text"], extracted["page_offsets"])
+                fingerprint = build_fingerprint(extracted["md_text"], extracted["page_offsets"], repeated_lines,
+                                                extracted["page_numbers"])
+
+                # Store extracted data in session state under the file's name
+                file_data = {
+                    "md_text": extracted["md_text"],
+                    "image_list": extracted["image_list"],  # encoded image blobs
+                    "image_sizes": extracted["image_sizes"],
+                    "image_pages": extracted["image_pages"],
+                    "page_offsets": extracted["page_offsets"],
+                    "page_numbers": extracted["page_numbers"],
+                    "page_count": extracted["page_count"],
+                    "page_range": page_range,
+                    "repeated_lines": repeated_lines,  # page headers and footers
+                    "page_edge_lines": find_page_edge_lines(extracted["md_text"], extracted["page_offsets"]),
+                    "images_hash": extracted["images_hash"],
+                    "file_hash": file_hash,
+                    "upload_id": upload_id,
+                    "fingerprint": fingerprint,
+                    "version": 1,
+                    "changes": None,
+                    "chunk_summaries": {},  # chunk hash -> summary, reused across revisions
+                    "summary": None,
+                    "analysis": None,
+                    "mermaid_code": None,
+                    "trd_content": None,
+                    "epics_user_stories": None,
+                    "use_summary": False  # Default to not using summary
+                }
+
+                apply_compression(uploaded_file.name, file_data, current_compression_rules())
+
+                if previous:
+                    # A revision or a new page range: keep the summaries of chunks whose sections did not change
+                    current_hashes = {chunk_hash for chunk_hash, _, _, _ in summary_chunks(file_data)}
+                    if same_content:
+                        file_data["version"] = previous["version"]
+                        file_data["changes"] = previous["changes"]
+                    else:
+                        file_data["version"] = previous["version"] + 1
+                        file_data["changes"] = diff_fingerprints(previous["fingerprint"], fingerprint)
+                        file_data["changes"]["previous_name"] = previous_name
+                    file_data["chunk_summaries"] = {
+                        chunk_hash: summary for chunk_hash, summary in previous["chunk_summaries"].items()
+                        if chunk_hash in current_hashes
                     }
+                    file_data["use_summary"] = previous["use_summary"]
+                    del st.session_state.files[previous_name]
+
+                st.session_state.files[uploaded_file.name] = file_data
 
-            except Exception as e:
-                st.error(f"An error occurred while processing {uploaded_file.name}.")
-                st.exception(e)
-            finally:
-                # Clean up the temporary file immediately after processing
-                if os.path.exists(temp_pdf_path):
-                    os.remove(temp_pdf_path)
+        except InvalidPageRangeError as e:
+            st.error(f"Could not extract {uploaded_file.name}: {e}")
+        except Exception as e:
+            st.error(f"An error occurred while processing {uploaded_file.name}.")
+            st.exception(e)
+        finally:
+            progress_bar.empty()
+
+# Re-compress prompt text when the compression rules have changed
+compression_rules = current_compression_rules()
+for file_name, file_data in st.session_state.files.items():
+    if file_data["compression_rules"] != compression_rules:
+        apply_compression(file_name, file_data, compression_rules)
 
 # --- Sidebar ---
 with st.sidebar:
@@ -151,11 +485,62 @@ with st.sidebar:
         <div class="sidebar-token-usage">
             <strong>Total:</strong> {st.session_state.token_counts['total']}<br>
             <strong>Prompt:</strong> {st.session_state.token_counts['prompt']}<br>
-            <strong>Output:</strong> {st.session_state.token_counts['output']}
+            <strong>Output:</strong> {st.session_state.token_counts['output']}<br>
+            <strong>Cost:</strong> ~${estimate_cost(st.session_state.token_counts['prompt'], st.session_state.token_counts['output']):.4f}
         </div>
         """,
         unsafe_allow_html=True
     )
+    ledger = get_usage_ledger()
+    ledger.refresh()
+    budget_lines = []
+    if BUDGET_SESSION_TOKENS:
+        budget_lines.append(f"<strong>Session budget:</strong> {st.session_state.token_counts['total']:,} / {BUDGET_SESSION_TOKENS:,}")
+    if BUDGET_MONTHLY_TOKENS:
+        budget_lines.append(f"<strong>Monthly budget:</strong> {ledger.current_month_tokens():,} / {BUDGET_MONTHLY_TOKENS:,}")
+    if budget_lines:
+        st.markdown(f'<div class="sidebar-token-usage">{"<br>".join(budget_lines)}</div>', unsafe_allow_html=True)
+    if ledger.by_prompt_type:
+        with st.expander("Usage by prompt type (all sessions)"):
+            rows = ["| Prompt type | Requests | Tokens | Cost |", "| --- | --- | --- | --- |"]
+            for prompt_type, row in sorted(ledger.by_prompt_type.items()):
+                rows.append(f"| {prompt_type} | {row['requests']} | {row['total']:,} | ${row['cost']:.4f} |")
+            st.markdown("\n".join(rows))
+
+    st.markdown("---")
+
+    st.markdown("## Page Range")
+    st.text_input(
+        "Pages to extract",
+        key="page_range",
+        placeholder="All pages",
+        help="Pages and ranges such as 1-20, 35, 40- to limit extraction and analysis to part of each PDF. Changing it re-extracts the uploaded files."
+    )
+
+    st.markdown("---")
+
+    st.markdown("## Prompt Compression")
+    for rule, label in COMPRESSION_RULES.items():
+        st.checkbox(label, value=DEFAULT_COMPRESSION_RULES[rule], key=f"compress_{rule}")
+    if st.session_state.files:
+        saved_tokens = sum(data["compression"]["saved_tokens"] for data in st.session_state.files.values())
+        st.markdown(
+            f'<div class="sidebar-token-usage"><strong>Saved per full-text prompt:</strong> ~{saved_tokens} tokens</div>',
+            unsafe_allow_html=True
+        )
+
+    st.markdown("---")
+
+    st.markdown("## Prompt Context")
+    st.radio(
+        "Send to Gemini",
+        CONTEXT_MODES,
+        key="context_mode",
+        help="Relevant sections sends only the parts of each document that matter most for the prompt, within the token budget."
+    )
+    if st.session_state.context_mode == "Relevant sections":
+        st.number_input("Token budget per prompt", min_value=1000, value=DEFAULT_CONTEXT_TOKEN_BUDGET, step=1000, key="context_token_budget")
+        st.number_input("Max sections per prompt", min_value=1, value=DEFAULT_CONTEXT_TOP_K, step=1, key="context_top_k")
 
     st.markdown("---")
 
@@ -178,108 +563,90 @@ else:
         st.subheader("Batch Actions")
         col1, col2, col3 = st.columns(3)
         with col1:
-            if st.button("Generate All Summaries", key="summarize_all_top"):
+            estimate = combine_estimates(estimate_summary(data) for data in st.session_state.files.values() if not data["summary"])
+            clicked = st.button("Generate All Summaries", key="summarize_all_top")
+            st.caption(format_estimate(estimate))
+            if clicked and within_budget(estimate):
                 with st.spinner("Generating all summaries..."):
                     for file_name, file_data in st.session_state.files.items():
                         if not file_data["summary"]:
-                            summary, token_info = summarize_text(file_data["md_text"], file_data["image_list"])
-                            if summary and token_info:
-                                file_data["summary"] = summary
-                                st.session_state.token_counts["prompt"] += token_info["prompt"]
-                                st.session_state.token_counts["output"] += token_info["output"]
-                                st.session_state.token_counts["total"] += token_info["total"]
+                            generate_summary(file_data)
                     st.rerun()
         with col2:
-            if st.button("Analyze All Business Plans", key="analyze_all_top"):
+            estimate = combine_estimates(
+                estimate_input("analysis", *file_prompt_input(data, "analysis"))
+                for data in st.session_state.files.values() if not data["analysis"]
+            )
+            clicked = st.button("Analyze All Business Plans", key="analyze_all_top")
+            st.caption(format_estimate(estimate))
+            if clicked and within_budget(estimate):
                 with st.spinner("Analyzing all business plans..."):
                     for file_name, file_data in st.session_state.files.items():
                         if not file_data["analysis"]:
-                            input_text = file_data["summary"] if file_data.get("use_summary", False) else file_data["md_text"]
-                            images_to_analyze = [] if file_data.get("use_summary", False) else file_data["image_list"]
+                            input_text, images_to_analyze = file_prompt_input(file_data, "analysis")
                             analysis, token_info = analyze_with_gemini(input_text, images_to_analyze)
                             if analysis and token_info:
                                 file_data["analysis"] = analysis
-                                st.session_state.token_counts["prompt"] += token_info["prompt"]
-                                st.session_state.token_counts["output"] += token_info["output"]
-                                st.session_state.token_counts["total"] += token_info["total"]
+                                record_usage(token_info, "analysis", file_data["file_hash"])
                     st.rerun()
         with col3:
-            if st.button("Generate All TRDs", key="trd_all_top"):
+            estimate = combine_estimates(
+                estimate_trd_parts(data, lambda prompt_type, data=data: file_prompt_input(data, prompt_type))
+                for data in st.session_state.files.values() if not all(data.get(key) for key in TRD_PARTS)
+            )
+            clicked = st.button("Generate All TRDs", key="trd_all_top")
+            st.caption(format_estimate(estimate))
+            if clicked and within_budget(estimate):
                 with st.spinner("Generating all TRDs..."):
+                    succeeded = True
                     for file_name, file_data in st.session_state.files.items():
-                        if not file_data["trd_content"]:
-                            input_text = file_data["summary"] if file_data.get("use_summary", False) else file_data["md_text"]
-                            images_to_analyze = [] if file_data.get("use_summary", False) else file_data["image_list"]
-                            mermaid_code, mermaid_token_info = generate_mermaid_req_doc(input_text, images_to_analyze)
-                            trd_content, trd_token_info = generate_trd_content(input_text, images_to_analyze)
-                            epics_user_stories, epics_token_info = generate_epics_and_user_stories(input_text, images_to_analyze)
-
-                            if mermaid_code and trd_content and epics_user_stories:
-                                file_data["mermaid_code"] = mermaid_code
-                                file_data["trd_content"] = trd_content
-                                file_data["epics_user_stories"] = epics_user_stories
-                                st.session_state.token_counts["prompt"] += mermaid_token_info["prompt"] + trd_token_info["prompt"] + epics_token_info["prompt"]
-                                st.session_state.token_counts["output"] += mermaid_token_info["output"] + trd_token_info["output"] + epics_token_info["output"]
-                                st.session_state.token_counts["total"] += mermaid_token_info["total"] + trd_token_info["total"] + epics_token_info["total"]
-                    st.rerun()
+                        if not all(file_data.get(key) for key in TRD_PARTS):
+                            succeeded &= generate_trd_parts(file_data, lambda prompt_type: file_prompt_input(file_data, prompt_type))
+                    if succeeded:
+                        st.rerun()
 
     # --- Global Batch Actions ---
     if len(st.session_state.files) > 1:
         st.subheader("Global Batch Actions (All Files Combined)")
         
-        # Combine all text and images for global analysis
-        combined_text = "\n\n--- \n\n".join([data["md_text"] for data in st.session_state.files.values()])
-        combined_images = [img for data in st.session_state.files.values() for img in data["image_list"]]
-
         g_col1, g_col2, g_col3 = st.columns(3)
         with g_col1:
-            if st.button("Generate Global Summary", key="summarize_global"):
+            estimate = estimate_input("summary", *global_prompt_input("summary", allow_summary=False))
+            clicked = st.button("Generate Global Summary", key="summarize_global")
+            st.caption(format_estimate(estimate))
+            if clicked and within_budget(estimate):
                 with st.spinner("Generating global summary..."):
-                    summary, token_info = summarize_text(combined_text, combined_images)
+                    input_text, images_to_analyze = global_prompt_input("summary", allow_summary=False)
+                    summary, token_info = summarize_text(input_text, images_to_analyze)
                     if summary and token_info:
                         st.session_state.global_analysis["summary"] = summary
-                        st.session_state.token_counts["prompt"] += token_info["prompt"]
-                        st.session_state.token_counts["output"] += token_info["output"]
-                        st.session_state.token_counts["total"] += token_info["total"]
+                        record_usage(token_info, "summary")
                         st.rerun()
         
         with g_col2:
-            if st.button("Analyze Global Business Plan", key="analyze_global"):
+            estimate = estimate_input("analysis", *global_prompt_input("analysis"))
+            clicked = st.button("Analyze Global Business Plan", key="analyze_global")
+            st.caption(format_estimate(estimate))
+            if clicked and within_budget(estimate):
                 with st.spinner("Analyzing global business plan..."):
-                    use_global_summary = st.session_state.global_analysis.get("use_summary", False)
-                    input_text = st.session_state.global_analysis["summary"] if use_global_summary and st.session_state.global_analysis["summary"] else combined_text
-                    images_to_analyze = [] if use_global_summary else combined_images
-                    
+                    input_text, images_to_analyze = global_prompt_input("analysis")
                     analysis, token_info = analyze_with_gemini(input_text, images_to_analyze)
                     if analysis and token_info:
                         st.session_state.global_analysis["analysis"] = analysis
-                        st.session_state.token_counts["prompt"] += token_info["prompt"]
-                        st.session_state.token_counts["output"] += token_info["output"]
-                        st.session_state.token_counts["total"] += token_info["total"]
+                        record_usage(token_info, "analysis")
                         st.rerun()
 
         with g_col3:
-            if st.button("Generate Global TRD", key="trd_global"):
+            estimate = estimate_trd_parts(st.session_state.global_analysis, global_prompt_input)
+            clicked = st.button("Generate Global TRD", key="trd_global")
+            st.caption(format_estimate(estimate))
+            if clicked and within_budget(estimate):
                 with st.spinner("Generating global TRD..."):
-                    use_global_summary = st.session_state.global_analysis.get("use_summary", False)
-                    input_text = st.session_state.global_analysis["summary"] if use_global_summary and st.session_state.global_analysis["summary"] else combined_text
-                    images_to_analyze = [] if use_global_summary else combined_images
-
-                    mermaid_code, mermaid_token_info = generate_mermaid_req_doc(input_text, images_to_analyze)
-                    trd_content, trd_token_info = generate_trd_content(input_text, images_to_analyze)
-                    epics_user_stories, epics_token_info = generate_epics_and_user_stories(input_text, images_to_analyze)
-
-                    if mermaid_code and trd_content and epics_user_stories:
-                        st.session_state.global_analysis["mermaid_code"] = mermaid_code
-                        st.session_state.global_analysis["trd_content"] = trd_content
-                        st.session_state.global_analysis["epics_user_stories"] = epics_user_stories
-                        st.session_state.token_counts["prompt"] += mermaid_token_info["prompt"] + trd_token_info["prompt"] + epics_token_info["prompt"]
-                        st.session_state.token_counts["output"] += mermaid_token_info["output"] + trd_token_info["output"] + epics_token_info["output"]
-                        st.session_state.token_counts["total"] += mermaid_token_info["total"] + trd_token_info["total"] + epics_token_info["total"]
+                    if generate_trd_parts(st.session_state.global_analysis, global_prompt_input):
                         st.rerun()
 
         # --- Display Global Analysis Results ---
-        if st.session_state.global_analysis["summary"] or st.session_state.global_analysis["analysis"] or st.session_state.global_analysis["trd_content"]:
+        if st.session_state.global_analysis["summary"] or st.session_state.global_analysis["analysis"] or any(st.session_state.global_analysis.get(key) for key in TRD_PARTS):
             st.markdown("### Global Analysis Results")
 
             if st.session_state.global_analysis["summary"]:
@@ -297,13 +664,17 @@ else:
                 with st.expander("View Global Business Analysis"):
                     st.markdown(st.session_state.global_analysis["analysis"])
 
+            missing_parts = missing_trd_parts(st.session_state.global_analysis)
+            if missing_parts:
+                st.warning(f"The global TRD was only partially generated. Missing: {', '.join(missing_parts)}. Click \"Generate Global TRD\" again to retry only the missing parts.")
+
             if st.session_state.global_analysis["mermaid_code"] and st.session_state.global_analysis["trd_content"]:
                 st.markdown("#### Global Technical Requirements Document")
                 with st.expander("View Global TRD Content", expanded=False):
                     st.markdown(st.session_state.global_analysis["trd_content"], unsafe_allow_html=True)
                 
                 st.markdown("##### Global System Architecture Diagram")
-                st_mermaid(st.session_state.global_analysis["mermaid_code"], key="global_mermaid")
+                render_mermaid(st.session_state.global_analysis["mermaid_code"], key="global_mermaid")
 
                 doc_stream = create_trd_word_document(
                     st.session_state.global_analysis["trd_content"], 
@@ -333,6 +704,21 @@ else:
         anchor_link = file_name.replace(' ', '-').replace('.', '-')
         st.markdown(f"<a name='{anchor_link}'></a>", unsafe_allow_html=True)
         st.header(f"Analysis for: {file_name}")
+        show_revision_changes(file_data)
+        if file_data["page_range"]:
+            st.caption(
+                f"Extracted pages {file_data['page_range']}: {len(file_data['page_numbers'])} of {file_data['page_count']} pages"
+            )
+        file_usage = get_usage_ledger().by_file.get(file_data["file_hash"])
+        if file_usage:
+            st.caption(f"Gemini usage for this file (all sessions): {file_usage['total']:,} tokens, ~${file_usage['cost']:.4f}")
+        compression = file_data["compression"]
+        if compression["original_tokens"]:
+            saved_share = compression["saved_tokens"] / compression["original_tokens"]
+            st.caption(
+                f"Prompt compression: ~{compression['original_tokens']} → ~{compression['compressed_tokens']} tokens "
+                f"(saved ~{compression['saved_tokens']}, {saved_share:.0%})"
+            )
 
         with st.expander("Extracted Content", expanded=False):
             st.subheader("Extracted Text")
@@ -341,20 +727,18 @@ else:
             st.subheader("Extracted Images")
             if file_data["image_list"]:
                 for i, image in enumerate(file_data["image_list"]):
-                    st.image(image, caption=f"Image {i+1}")
+                    st.image(image["data"], caption=f"Image {i+1} (page {file_data['image_pages'][i]})")
             else:
                 st.info("No images found in this PDF.")
 
         # --- Summarization Section ---
         st.subheader("Token Optimization: Summary")
-        if st.button(f"Generate Summary for {file_name}", key=f"summary_{file_name}"):
+        estimate = estimate_summary(file_data)
+        clicked = st.button(f"Generate Summary for {file_name}", key=f"summary_{file_name}")
+        st.caption(format_estimate(estimate))
+        if clicked and within_budget(estimate):
             with st.spinner("Generating summary..."):
-                summary, token_info = summarize_text(file_data["md_text"], file_data["image_list"])
-                if summary and token_info:
-                    file_data["summary"] = summary
-                    st.session_state.token_counts["prompt"] += token_info["prompt"]
-                    st.session_state.token_counts["output"] += token_info["output"]
-                    st.session_state.token_counts["total"] += token_info["total"]
+                if generate_summary(file_data):
                     st.rerun()
 
         if file_data["summary"]:
@@ -375,36 +759,26 @@ else:
         col1, col2 = st.columns(2)
 
         with col1:
-            if st.button(f"Analyze Business Plan for {file_name}", key=f"analyze_{file_name}"):
+            estimate = estimate_input("analysis", *file_prompt_input(file_data, "analysis"))
+            clicked = st.button(f"Analyze Business Plan for {file_name}", key=f"analyze_{file_name}")
+            st.caption(format_estimate(estimate))
+            if clicked and within_budget(estimate):
                 with st.spinner("Analyzing with Gemini..."):
-                    input_text = file_data["summary"] if file_data["use_summary"] else file_data["md_text"]
-                    images_to_analyze = [] if file_data["use_summary"] else file_data["image_list"]
+                    input_text, images_to_analyze = file_prompt_input(file_data, "analysis")
 
                     analysis, token_info = analyze_with_gemini(input_text, images_to_analyze)
                     if analysis and token_info:
                         file_data["analysis"] = analysis
-                        st.session_state.token_counts["prompt"] += token_info["prompt"]
-                        st.session_state.token_counts["output"] += token_info["output"]
-                        st.session_state.token_counts["total"] += token_info["total"]
+                        record_usage(token_info, "analysis", file_data["file_hash"])
                         st.rerun()
 
         with col2:
-            if st.button(f"Generate TRD for {file_name}", key=f"trd_{file_name}"):
+            estimate = estimate_trd_parts(file_data, lambda prompt_type: file_prompt_input(file_data, prompt_type))
+            clicked = st.button(f"Generate TRD for {file_name}", key=f"trd_{file_name}")
+            st.caption(format_estimate(estimate))
+            if clicked and within_budget(estimate):
                 with st.spinner("Generating Technical Requirements Document..."):
-                    input_text = file_data["summary"] if file_data["use_summary"] else file_data["md_text"]
-                    images_to_analyze = [] if file_data["use_summary"] else file_data["image_list"]
-
-                    mermaid_code, mermaid_token_info = generate_mermaid_req_doc(input_text, images_to_analyze)
-                    trd_content, trd_token_info = generate_trd_content(input_text, images_to_analyze)
-                    epics_user_stories, epics_token_info = generate_epics_and_user_stories(input_text, images_to_analyze)
-
-                    if mermaid_code and trd_content and epics_user_stories:
-                        file_data["mermaid_code"] = mermaid_code
-                        file_data["trd_content"] = trd_content
-                        file_data["epics_user_stories"] = epics_user_stories
-                        st.session_state.token_counts["prompt"] += mermaid_token_info["prompt"] + trd_token_info["prompt"] + epics_token_info["prompt"]
-                        st.session_state.token_counts["output"] += mermaid_token_info["output"] + trd_token_info["output"] + epics_token_info["output"]
-                        st.session_state.token_counts["total"] += mermaid_token_info["total"] + trd_token_info["total"] + epics_token_info["total"]
+                    if generate_trd_parts(file_data, lambda prompt_type: file_prompt_input(file_data, prompt_type)):
                         st.rerun()
     
                         
@@ -414,6 +788,10 @@ else:
             with st.expander("View Business Analysis"):
                 st.markdown(file_data["analysis"], unsafe_allow_html=True)
 
+        missing_parts = missing_trd_parts(file_data)
+        if missing_parts:
+            st.warning(f"The TRD was only partially generated. Missing: {', '.join(missing_parts)}. Click \"Generate TRD\" again to retry only the missing parts.")
+
         if file_data["mermaid_code"] and file_data["trd_content"]:
             st.markdown("### Technical Requirements Document")
             st.success("TRD generated successfully!")
@@ -422,7 +800,7 @@ else:
                 st.markdown(file_data["trd_content"], unsafe_allow_html=True)
 
             st.markdown("#### System Architecture Diagram")
-            st_mermaid(file_data["mermaid_code"], key=f"mermaid_{file_name}")
+            render_mermaid(file_data["mermaid_code"], key=f"mermaid_{file_name}")
 
             doc_stream = create_trd_word_document(
                 file_data["trd_content"], 
@@ -0,0 +1,151 @@
+"""
+Startup benchmark for the BA Agent Streamlit app.
+
+Every trial runs in a fresh Python process so that nothing is served from
+sys.modules, and measures:
+
+- interpreter start: from spawning the process until the child runs its first line
+- app import: importing the app's own modules (what a Streamlit worker pays on
+  the first script run)
+- first render: running ba-agent.py once through Streamlit's AppTest harness
+- process total: wall time from spawn until the first render is finished
+
+It also reports which heavy dependencies were loaded by the first render, so
+an accidental top-level import shows up immediately.
+
+Usage:
+    python bench_startup.py [--trials 5] [--deps]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_FILE = os.path.join(APP_DIR, "ba-agent.py")
+
+# Dependencies that should only be imported once the feature needing them is used.
+HEAVY_MODULES = [
+    "google.generativeai",
+    "pymupdf4llm",
+    "fitz",
+    "PIL.Image",
+    "streamlit_mermaid",
+    "docx",
+    "requests",
+    "numpy",
+]
+
+_CHILD_SCRIPT = r"""
+import json, sys, time
+started = time.time()
+sys.path.insert(0, {app_dir!r})
+
+t0 = time.perf_counter()
+import gemini_utils, docx_utils, extraction_utils, analysis_utils, ui_utils, prompts
+import retrieval_utils, compression_utils, revision_utils, mermaid_utils, budget_utils
+app_import = time.perf_counter() - t0
+
+from streamlit.testing.v1 import AppTest
+t0 = time.perf_counter()
+at = AppTest.from_file({app_file!r}, default_timeout=120)
+at.run()
+first_render = time.perf_counter() - t0
+
+print(json.dumps({{
+    "started": started,
+    "app_import": app_import,
+    "first_render": first_render,
+    "exception": [str(e.value) for e in at.exception],
+    "loaded": [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+_IMPORT_SCRIPT = r"""
+import time
+t0 = time.perf_counter()
+import {module}
+print(time.perf_counter() - t0)
+"""
+
+
+def _child_env():
+    env = dict(os.environ)
+    # The app stops early without a key; a dummy value is enough because the
+    # first render does not call the API.
+    env.setdefault("GOOGLE_API_KEY", "benchmark-dummy-key")
+    return env
+
+
+def run_trial():
+    """Runs one cold-start trial in a fresh process and returns its timings."""
+    script = _CHILD_SCRIPT.format(app_dir=APP_DIR, app_file=APP_FILE, heavy=HEAVY_MODULES)
+    spawned = time.time()
+    result = subprocess.run(
+        [sys.executable, "-c", script],
+        cwd=APP_DIR,
+        env=_child_env(),
+        capture_output=True,
+        text=True,
+    )
+    finished = time.time()
+    if result.returncode != 0:
+        raise RuntimeError(f"Benchmark child failed:\n{result.stderr}")
+
+    data = json.loads(result.stdout.strip().splitlines()[-1])
+    data["interpreter_start"] = data.pop("started") - spawned
+    data["process_total"] = finished - spawned
+    return data
+
+
+def time_dependency_imports():
+    """Measures the cold import time of each heavy dependency on its own."""
+    timings = {}
+    for module in HEAVY_MODULES:
+        result = subprocess.run(
+            [sys.executable, "-c", _IMPORT_SCRIPT.format(module=module)],
+            capture_output=True,
+            text=True,
+        )
+        timings[module] = float(result.stdout.strip()) if result.returncode == 0 else None
+    return timings
+
+
+def _describe(values):
+    return (
+        f"median {statistics.median(values) * 1000:8.1f} ms | "
+        f"min {min(values) * 1000:8.1f} ms | max {max(values) * 1000:8.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trials", type=int, default=5, help="Number of cold-start trials to run.")
+    parser.add_argument("--deps", action="store_true", help="Also time each heavy dependency import on its own.")
+    args = parser.parse_args()
+
+    trials = [run_trial() for _ in range(args.trials)]
+
+    print(f"Cold start over {args.trials} trial(s):")
+    for metric in ("interpreter_start", "app_import", "first_render", "process_total"):
+        print(f"  {metric:<18} {_describe([t[metric] for t in trials])}")
+
+    loaded = sorted({m for t in trials for m in t["loaded"]})
+    print(f"  heavy modules loaded by first render: {', '.join(loaded) if loaded else 'none'}")
+
+    exceptions = [e for t in trials for e in t["exception"]]
+    if exceptions:
+        print(f"  first render raised: {exceptions[0]}")
+
+    if args.deps:
+        print("Standalone import times:")
+        for module, seconds in time_dependency_imports().items():
+            shown = f"{seconds * 1000:8.1f} ms" if seconds is not None else "not installed"
+            print(f"  {module:<20} {shown}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+# budget_utils.py
+import os
+import json
+import math
+import threading
+from datetime import datetime, timezone
+import streamlit as st
+from compression_utils import estimate_tokens
+from prompts import (
+    SUMMARIZE_PROMPT,
+    SECTION_SUMMARY_PROMPT,
+    ANALYZE_PROMPT,
+    MERMAID_PROMPT,
+    TRD_PROMPT,
+    EPICS_USER_STORIES_PROMPT,
+)
+
+# Prices in USD per million tokens. The defaults are Gemini 2.5 Flash's paid
+# tier prices; images are billed as input tokens.
+GEMINI_INPUT_PRICE_PER_MILLION = float(os.getenv("GEMINI_INPUT_PRICE_PER_MILLION", "0.30"))
+GEMINI_OUTPUT_PRICE_PER_MILLION = float(os.getenv("GEMINI_OUTPUT_PRICE_PER_MILLION", "2.50"))
+
+# Token budgets. 0 disables a budget. The deployment budget covers all
+# sessions in the current calendar month (UTC), as recorded in the ledger.
+BUDGET_SESSION_TOKENS = int(os.getenv("BUDGET_SESSION_TOKENS", "0"))
+BUDGET_MONTHLY_TOKENS = int(os.getenv("BUDGET_MONTHLY_TOKENS", "0"))
+BUDGET_ENFORCEMENT = os.getenv("BUDGET_ENFORCEMENT", "warn").lower()  # "warn" or "stop"
+BUDGET_WARN_SHARE = float(os.getenv("BUDGET_WARN_SHARE", "0.8"))
+
+USAGE_LEDGER_PATH = os.getenv("USAGE_LEDGER_PATH", "usage_ledger.jsonl")
+
+# Images up to this size in both dimensions cost a flat IMAGE_TOKENS. Larger
+# images are split into IMAGE_TILE_PIXELS tiles of IMAGE_TOKENS each.
+IMAGE_SMALL_PIXELS = 384
+IMAGE_TILE_PIXELS = 768
+IMAGE_TOKENS = 258
+
+PROMPT_TEMPLATES = {
+    "summary": SUMMARIZE_PROMPT,
+    "section_summary": SECTION_SUMMARY_PROMPT,
+    "analysis": ANALYZE_PROMPT,
+    "mermaid": MERMAID_PROMPT,
+    "trd": TRD_PROMPT,
+    "epics": EPICS_USER_STORIES_PROMPT,
+}
+
+# Expected response lengths until the ledger has real averages.
+DEFAULT_OUTPUT_TOKENS = {
+    "summary": 1200,
+    "section_summary": 500,
+    "analysis": 2500,
+    "mermaid": 600,
+    "trd": 5000,
+    "epics": 3500,
+}
+
+
+def estimate_image_tokens(width, height):
+    """Estimates the input tokens of one image from its size in pixels."""
+    if width <= IMAGE_SMALL_PIXELS and height <= IMAGE_SMALL_PIXELS:
+        return IMAGE_TOKENS
+    return math.ceil(width / IMAGE_TILE_PIXELS) * math.ceil(height / IMAGE_TILE_PIXELS) * IMAGE_TOKENS
+
+
+def estimate_cost(prompt_tokens, output_tokens):
+    """Returns the cost in USD of the given input and output tokens."""
+    return (prompt_tokens * GEMINI_INPUT_PRICE_PER_MILLION + output_tokens * GEMINI_OUTPUT_PRICE_PER_MILLION) / 1_000_000
+
+
+def estimate_request(prompt_type, text, image_sizes=(), output_tokens=None):
+    """
+    Estimates the tokens and cost of one Gemini request before it is sent.
+
+    Args:
+        prompt_type (str): A key of PROMPT_TEMPLATES.
+        text (str): The text content sent with the prompt.
+        image_sizes (list, optional): The (width, height) of each image sent.
+        output_tokens (int, optional): The expected response tokens. Defaults
+            to DEFAULT_OUTPUT_TOKENS for the prompt type.
+
+    Returns:
+        dict: The estimated 'prompt', 'output' and 'total' tokens, the
+              projected 'cost' in USD and the number of 'requests' (1).
+    """
+    if not text:
+        return empty_estimate()
+    prompt_tokens = estimate_tokens(PROMPT_TEMPLATES[prompt_type]) + estimate_tokens(text)
+    prompt_tokens += sum(estimate_image_tokens(width, height) for width, height in image_sizes)
+    if output_tokens is None:
+        output_tokens = DEFAULT_OUTPUT_TOKENS[prompt_type]
+    return {
+        "prompt": prompt_tokens,
+        "output": output_tokens,
+        "total": prompt_tokens + output_tokens,
+        "cost": estimate_cost(prompt_tokens, output_tokens),
+        "requests": 1,
+    }
+
+
+def empty_estimate():
+    """Returns the estimate of an action that sends no requests."""
+    return {"prompt": 0, "output": 0, "total": 0, "cost": 0.0, "requests": 0}
+
+
+def combine_estimates(estimates):
+    """Adds up the estimates of the requests that make up one action."""
+    combined = empty_estimate()
+    for estimate in estimates:
+        for key in combined:
+            combined[key] += estimate[key]
+    return combined
+
+
+def format_estimate(estimate):
+    """Formats an estimate for display next to an action button."""
+    if not estimate["requests"]:
+        return "Nothing to send."
+    requests = f"{estimate['requests']} requests, " if estimate["requests"] > 1 else ""
+    return f"Estimate: {requests}~{estimate['total']:,} tokens, ~${estimate['cost']:.4f}"
+
+
+def check_budget(estimate, session_tokens, monthly_tokens):
+    """
+    Checks an action's estimate against the session and monthly budgets.
+
+    Args:
+        estimate (dict): The action's estimate from estimate_request or combine_estimates.
+        session_tokens (int): The tokens this session has used so far.
+        monthly_tokens (int): The tokens all sessions have used this month.
+
+    Returns:
+        tuple: 'ok', 'warn' or 'stop', and a message (None if 'ok').
+    """
+    level, messages = "ok", []
+    for name, budget, used in (("session", BUDGET_SESSION_TOKENS, session_tokens),
+                               ("monthly", BUDGET_MONTHLY_TOKENS, monthly_tokens)):
+        if not budget:
+            continue
+        projected = used + estimate["total"]
+        if projected > budget:
+            level = "stop" if BUDGET_ENFORCEMENT == "stop" else "warn"
+            messages.append(f"This would bring the {name} token usage to ~{projected:,}, over the budget of {budget:,}.")
+        elif projected > budget * BUDGET_WARN_SHARE:
+            level = "warn" if level == "ok" else level
+            messages.append(f"This brings the {name} token usage to ~{projected:,} of the {budget:,} budget.")
+    return level, " ".join(messages) or None
+
+
+class UsageLedger:
+    """
+    An append-only JSONL ledger of the tokens used by every Gemini request,
+    shared by all sessions of the process and, through the file, by every
+    replica of the deployment that writes to the same path.
+
+    Totals per month, prompt type and file hash are kept in memory. refresh()
+    reads only the lines appended since the last read, including those
+    written by other processes, so the budgets cover the whole deployment
+    without re-reading the file.
+    """
+
+    def __init__(self, path=USAGE_LEDGER_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._offset = 0
+        self._reset()
+        self.refresh()
+
+    def _reset(self):
+        self._offset = 0
+        self.monthly_tokens = {}
+        self.by_prompt_type = {}
+        self.by_file = {}
+
+    def refresh(self):
+        """Adds the entries appended to the ledger file since it was last read."""
+        with self._lock:
+            self._read_new_entries()
+
+    def _read_new_entries(self):
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() < self._offset:
+                    self._reset()  # the ledger was truncated or rotated
+                f.seek(self._offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # A line another process is still writing is left for the next read
+        complete = data[:data.rfind(b"\n") + 1]
+        self._offset += len(complete)
+        for line in complete.splitlines():
+            try:
+                self._add(json.loads(line))
+            except (ValueError, KeyError):
+                continue  # a corrupted line
+
+    def _add(self, entry):
+        month = entry["time"][:7]
+        self.monthly_tokens[month] = self.monthly_tokens.get(month, 0) + entry["total"]
+        if entry.get("shared"):
+            return  # reused another session's result at no cost
+        for totals, key in ((self.by_prompt_type, entry["prompt_type"]), (self.by_file, entry["file_hash"])):
+            row = totals.setdefault(key, {"requests": 0, "prompt": 0, "output": 0, "total": 0, "cost": 0.0})
+            row["requests"] += 1
+            for field in ("prompt", "output", "total", "cost"):
+                row[field] += entry[field]
+
+    def record(self, prompt_type, token_info, file_hash=None, session_id=None):
+        """Appends the usage of one request to the ledger."""
+        entry = {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "session": session_id,
+            "prompt_type": prompt_type,
+            "file_hash": file_hash or "global",
+            "prompt": token_info["prompt"],
+            "output": token_info["output"],
+            "total": token_info["total"],
+            "cost": estimate_cost(token_info["prompt"], token_info["output"]),
+            "shared": token_info.get("shared", False),
+        }
+        with self._lock:
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry) + "\n")
+            except OSError as e:
+                st.warning(f"Could not write the usage ledger: {e}")
+                self._add(entry)
+                return
+            # Picks up the new entry along with any written by other processes
+            self._read_new_entries()
+
+    def current_month_tokens(self):
+        """Returns the tokens recorded in the current calendar month (UTC)."""
+        return self.monthly_tokens.get(datetime.now(timezone.utc).strftime("%Y-%m"), 0)
+
+    def average_output_tokens(self, prompt_type):
+        """Returns the average response tokens recorded for a prompt type, or None if there are none."""
+        row = self.by_prompt_type.get(prompt_type)
+        if not row or not row["output"]:
+            return None
+        return row["output"] // row["requests"]
+
+
+@st.cache_resource(show_spinner=False)
+def get_usage_ledger(path=USAGE_LEDGER_PATH):
+    """Returns the process-wide UsageLedger."""
+    return UsageLedger(path)
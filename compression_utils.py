@@ -0,0 +1,202 @@
+# compression_utils.py
+import re
+import bisect
+from collections import Counter
+from extraction_utils import split_sections
+
+# Rules applied to extracted markdown before it is sent to Gemini. Each rule
+# can be switched off from the sidebar.
+COMPRESSION_RULES = {
+    "repeated_lines": "Remove repeated page headers and footers",
+    "page_numbers": "Remove page numbers",
+    "table_padding": "Collapse table padding",
+    "whitespace": "Collapse whitespace",
+    "drop_toc": "Drop table of contents",
+    "drop_appendix": "Drop appendix sections",
+}
+DEFAULT_COMPRESSION_RULES = {
+    "repeated_lines": True,
+    "page_numbers": True,
+    "table_padding": True,
+    "whitespace": True,
+    "drop_toc": False,
+    "drop_appendix": False,
+}
+
+# Page headers, footers and page numbers are only looked for in the first and
+# last REPEATED_LINE_EDGE non-empty lines of each page. A line is treated as a
+# header or footer when it appears there on at least this share of pages (and
+# at least REPEATED_LINE_MIN_PAGES pages).
+REPEATED_LINE_EDGE = 3
+REPEATED_LINE_MIN_PAGES = 3
+REPEATED_LINE_MIN_SHARE = 0.5
+
+# "12", "Page 12", "12 of 40", "12/40" or "- 12 -". A dash on one side only is a list item.
+_PAGE_NUMBER = re.compile(r'^\s*(?:(?:page\s*)?\d+(?:\s*(?:of|/)\s*\d+)?|[-–—]\s*\d+\s*[-–—])\s*$', re.IGNORECASE)
+_TOC_TITLE = re.compile(r'^(?:table\s+of\s+contents|contents|index)$', re.IGNORECASE)
+_TOC_ENTRY = re.compile(r'^.{2,}?(?:\s*\.{3,}|\s*…+|\s{3,})\s*\d+\s*$')
+_APPENDIX_TITLE = re.compile(r'^(?:appendix|appendices|annex|annexure)\b', re.IGNORECASE)
+_TABLE_SEPARATOR_CELL = re.compile(r'^:?-+:?$')
+_LINE_BREAKS = "\r\n\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"  # what str.splitlines splits on
+
+
+def estimate_tokens(text):
+    """Estimates the number of tokens in a text locally, at roughly four characters per token."""
+    return (len(text) + 3) // 4 if text else 0
+
+
+def normalize_line(line):
+    """Normalizes a line for header/footer matching: digits are masked and whitespace collapsed."""
+    return re.sub(r'\d+', '#', " ".join(line.split())).lower()
+
+
+def is_page_number(line):
+    """Returns whether a line holds only a page number, such as "12", "Page 3 of 40" or "- 7 -"."""
+    return bool(_PAGE_NUMBER.match(line))
+
+
+def _page_edges(md_text, page_offsets):
+    """Returns, for each page, the (offset, line) of its first and last REPEATED_LINE_EDGE non-empty lines."""
+    if not page_offsets:
+        return []
+    pages = [[] for _ in page_offsets]
+    offset = 0
+    for line in md_text.splitlines(keepends=True):
+        if line.strip():
+            pages[max(bisect.bisect_right(page_offsets, offset) - 1, 0)].append((offset, line.rstrip(_LINE_BREAKS)))
+        offset += len(line)
+    return [lines[:REPEATED_LINE_EDGE] + lines[REPEATED_LINE_EDGE:][-REPEATED_LINE_EDGE:] for lines in pages]
+
+
+def find_page_edge_lines(md_text, page_offsets):
+    """
+    Finds the lines where page headers, footers and page numbers can appear.
+
+    Returns:
+        frozenset: The offsets in md_text of the first and last
+                   REPEATED_LINE_EDGE non-empty lines of each page.
+    """
+    return frozenset(offset for edges in _page_edges(md_text, page_offsets) for offset, _ in edges)
+
+
+def find_repeated_lines(md_text, page_offsets):
+    """
+    Finds page header and footer lines that repeat across pages.
+
+    Args:
+        md_text (str): The extracted markdown text.
+        page_offsets (list): The offset at which each page starts in md_text.
+
+    Returns:
+        frozenset: The normalized forms (see normalize_line) of the repeated lines.
+    """
+    if len(page_offsets) < REPEATED_LINE_MIN_PAGES:
+        return frozenset()
+
+    counts = Counter()
+    for edges in _page_edges(md_text, page_offsets):
+        # Headings and table rows are real content even when they repeat on every page.
+        counts.update({normalize_line(line) for _, line in edges if not line.lstrip().startswith(('#', '|'))})
+
+    min_pages = max(REPEATED_LINE_MIN_PAGES, REPEATED_LINE_MIN_SHARE * len(page_offsets))
+    return frozenset(line for line, count in counts.items() if count >= min_pages)
+
+
+def _drop_sections(text, title_pattern, with_subsections):
+    """Removes sections whose title matches the pattern, optionally together with their subsections."""
+    kept = []
+    dropped_level = None
+    for section in split_sections(text, max_level=6):
+        if dropped_level is not None and section['level'] > dropped_level:
+            continue
+        dropped_level = None
+        if section['level'] and title_pattern.match(section['title']):
+            if with_subsections:
+                dropped_level = section['level']
+            continue
+        kept.append(text[section['start']:section['end']])
+    return "".join(kept)
+
+
+def _compress_table_row(line):
+    cells = [cell.strip() for cell in line.strip().strip('|').split('|')]
+    if not any(cells):
+        return None
+    if all(_TABLE_SEPARATOR_CELL.match(cell) for cell in cells):
+        cells = ['---' for _ in cells]
+    return '|' + '|'.join(cells) + '|'
+
+
+def compress_markdown(md_text, rules=None, repeated_lines=frozenset(), edge_lines=frozenset(), offset=0):
+    """
+    Deterministically strips boilerplate from extracted markdown.
+
+    Page headers, footers and page numbers are only removed from the lines at
+    page edges, so figures and repeated phrases in the body are kept.
+
+    Args:
+        md_text (str): The markdown to compress.
+        rules (dict, optional): Rule name -> enabled, see COMPRESSION_RULES.
+            Defaults to DEFAULT_COMPRESSION_RULES.
+        repeated_lines (frozenset, optional): Header and footer lines found by
+            find_repeated_lines.
+        edge_lines (frozenset, optional): The offsets of page edge lines in the
+            whole document, from find_page_edge_lines.
+        offset (int, optional): The offset of md_text in the whole document,
+            if it is only part of it.
+
+    Returns:
+        tuple: The compressed text (str) and a dictionary with the estimated
+               'original_tokens', 'compressed_tokens' and 'saved_tokens'.
+    """
+    rules = {**DEFAULT_COMPRESSION_RULES, **(rules or {})}
+
+    lines = []
+    toc_run = []
+    line_offset = offset
+    for line in md_text.splitlines(keepends=True):
+        at_page_edge = line_offset in edge_lines
+        line_offset += len(line)
+        line = line.rstrip(_LINE_BREAKS)
+        if at_page_edge and rules["repeated_lines"] and repeated_lines and normalize_line(line) in repeated_lines:
+            continue
+        if at_page_edge and rules["page_numbers"] and _PAGE_NUMBER.match(line):
+            continue
+        if rules["table_padding"] and line.lstrip().startswith('|'):
+            line = _compress_table_row(line)
+            if line is None:
+                continue
+        elif rules["whitespace"]:
+            stripped = line.rstrip()
+            indent = stripped[:len(stripped) - len(stripped.lstrip())]
+            line = indent + " ".join(stripped.split())
+
+        # Runs of dot-leader lines ("Market Analysis ....... 12") are an
+        # untitled table of contents.
+        if rules["drop_toc"]:
+            if _TOC_ENTRY.match(line.strip()):
+                toc_run.append(line)
+                continue
+            if len(toc_run) < 3:
+                lines.extend(toc_run)
+            toc_run = []
+        lines.append(line)
+    if len(toc_run) < 3:
+        lines.extend(toc_run)
+
+    text = "\n".join(lines)
+    # Sections are dropped after the line rules, which need the original offsets
+    if rules["drop_appendix"]:
+        text = _drop_sections(text, _APPENDIX_TITLE, with_subsections=True)
+    if rules["drop_toc"]:
+        text = _drop_sections(text, _TOC_TITLE, with_subsections=False)
+    if rules["whitespace"]:
+        text = re.sub(r'\n{3,}', '\n\n', text).strip() + "\n"
+
+    original_tokens = estimate_tokens(md_text)
+    compressed_tokens = estimate_tokens(text)
+    return text, {
+        "original_tokens": original_tokens,
+        "compressed_tokens": compressed_tokens,
+        "saved_tokens": original_tokens - compressed_tokens,
+    }
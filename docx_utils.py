@@ -1,72 +1,9 @@
 import streamlit as st
 import re
-from docx import Document
-from docx.shared import Inches
 import io
 import base64
-import requests
-import google.generativeai as genai
-from prompts import MERMAID_PROMPT, TRD_PROMPT
 
 
-
-def generate_mermaid_req_doc(md_text):
-    """Generates a technical requirements document in Mermaid.js format."""
-    model = genai.GenerativeModel('gemini-1.5-flash')
-
-    prompt = MERMAID_PROMPT.format(md_text=md_text)
-
-    try:
-        response = model.generate_content(prompt)
-        # Clean the response to ensure it's valid Mermaid code
-        mermaid_code = response.text
-        # The model might still wrap the code in markdown fences. Let's extract it.
-        match = re.search(r"```mermaid\n(.*?)\n```", mermaid_code, re.DOTALL)
-        if match:
-            mermaid_code = match.group(1).strip()
-        else:
-            mermaid_code = mermaid_code.strip()
-
-        # Fallback to remove parentheses only from within node labels
-        def clean_label(match):
-            label_content = match.group(1)
-            cleaned_content = re.sub(r'[\(\)]', '', label_content)
-            return f'[{cleaned_content}]'
-
-        mermaid_code = re.sub(r'\[(.*?)\]', clean_label, mermaid_code)
-
-        usage = response.usage_metadata
-        token_info = {
-            "prompt": usage.prompt_token_count,
-            "output": usage.candidates_token_count,
-            "total": usage.total_token_count
-        }
-        return mermaid_code.strip(), token_info
-
-    except Exception as e:
-        st.error(f"An error occurred during Mermaid diagram generation: {e}")
-        return None, None
-
-
-def generate_trd_content(md_text):
-    """Generates a full technical requirements document based on the business plan."""
-    model = genai.GenerativeModel('gemini-1.5-flash')
-
-    prompt = TRD_PROMPT.format(md_text=md_text)
-
-    try:
-        response = model.generate_content(prompt)
-        usage = response.usage_metadata
-        token_info = {
-            "prompt": usage.prompt_token_count,
-            "output": usage.candidates_token_count,
-            "total": usage.total_token_count
-        }
-        return response.text, token_info
-    except Exception as e:
-        st.error(f"An error occurred during TRD content generation: {e}")
-        return None, None
-
 def add_md_to_doc(document, markdown_text):
     """
     Parses markdown text and adds it to a python-docx document.
@@ -121,8 +58,42 @@ def add_md_to_doc(document, markdown_text):
         
         i += 1
 
+# Timeout for rendering a diagram through mermaid.ink, in seconds
+MERMAID_INK_TIMEOUT_SECONDS = 30
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def _fetch_mermaid_ink(mermaid_code):
+    """Fetches the PNG rendering of a diagram from mermaid.ink. Only successful renders are cached."""
+    import requests
+
+    base64_string = base64.b64encode(mermaid_code.encode("utf8")).decode("utf-8")
+    response = requests.get(f"https://mermaid.ink/img/{base64_string}", timeout=MERMAID_INK_TIMEOUT_SECONDS)
+    response.raise_for_status()
+    return response.content
+
+
+def fetch_mermaid_image(mermaid_code):
+    """
+    Returns the PNG rendering of a Mermaid diagram, or None if it could not be fetched.
+
+    Renders are cached per diagram, so reruns that redraw the download button
+    do not fetch the same image from mermaid.ink again.
+    """
+    try:
+        return _fetch_mermaid_ink(mermaid_code)
+    except Exception as e:
+        st.error(f"Failed to fetch diagram image from mermaid.ink: {e}")
+        return None
+
+
 def create_trd_word_document(trd_content, mermaid_code, epics_user_stories=None, extracted_text=None):
     """Creates a Word document with TRD content, a Mermaid diagram, epics/user stories, and an appendix with the full extracted text."""
+    # python-docx is only needed once a TRD is exported, so it is imported
+    # here instead of slowing down every app start.
+    from docx import Document
+    from docx.shared import Inches
+
     try:
         document = Document()
         
@@ -133,19 +104,12 @@ def create_trd_word_document(trd_content, mermaid_code, epics_user_stories=None,
         document.add_page_break()
         document.add_heading('System Architecture Diagram', level=1)
         
-        # Generate the image URL from mermaid.ink
-        graphbytes = mermaid_code.encode("utf8")
-        base64_bytes = base64.b64encode(graphbytes)
-        base64_string = base64_bytes.decode("utf-8")
-        img_url = f"https://mermaid.ink/img/{base64_string}"
-
-        # Fetch the image
-        response = requests.get(img_url)
-        if response.status_code != 200:
-            st.error(f"Failed to fetch diagram image from mermaid.ink. Status: {response.status_code}")
+        # Render the diagram through mermaid.ink
+        image_bytes = fetch_mermaid_image(mermaid_code)
+        if image_bytes is None:
             return None
 
-        image_stream = io.BytesIO(response.content)
+        image_stream = io.BytesIO(image_bytes)
         document.add_picture(image_stream, width=Inches(6.0))
 
         # Add Epics and User Stories if they exist
@@ -1,6 +1,195 @@
 import re
+import bisect
+import hashlib
 import streamlit as st
 
+# Pages converted per pymupdf4llm call. Memory use during extraction grows
+# with the batch size rather than with the length of the document.
+EXTRACTION_BATCH_PAGES = 10
+
+# Image formats Gemini accepts as-is; other embedded formats are converted to PNG.
+_GEMINI_IMAGE_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "jpg": "image/jpeg", "webp": "image/webp"}
+
+
+class InvalidPageRangeError(ValueError):
+    """Raised when a page range cannot be parsed or selects no pages of a document."""
+
+
+def parse_page_ranges(page_range, page_count):
+    """
+    Parses a page range such as "1-20, 35, 40-" into 0-based page indexes.
+
+    Pages beyond the end of the document are ignored.
+
+    Args:
+        page_range (str): Comma-separated pages and ranges. Empty selects all pages.
+        page_count (int): The number of pages in the document.
+
+    Returns:
+        list: The sorted 0-based indexes of the selected pages.
+
+    Raises:
+        InvalidPageRangeError: If the range is malformed or selects no pages.
+    """
+    if not page_range.strip():
+        return list(range(page_count))
+
+    selected = set()
+    for part in page_range.split(","):
+        match = re.fullmatch(r'\s*(\d+)\s*(?:(-)\s*(\d*)\s*)?', part)
+        if not match:
+            raise InvalidPageRangeError(f'"{part.strip()}" is not a page or page range.')
+        first = int(match.group(1))
+        last = (int(match.group(3)) if match.group(3) else max(first, page_count)) if match.group(2) else first
+        if first < 1 or last < first:
+            raise InvalidPageRangeError(f'"{part.strip()}" is not a valid page range.')
+        selected.update(range(first - 1, min(last, page_count)))
+    if not selected:
+        raise InvalidPageRangeError(f"The range {page_range} selects none of the document's {page_count} pages.")
+    return sorted(selected)
+
+
+def _image_blob(doc, xref, base_image):
+    """Returns an embedded image as a Gemini blob, converting formats Gemini does not accept to PNG."""
+    import fitz  # PyMuPDF
+
+    mime_type = _GEMINI_IMAGE_TYPES.get(base_image["ext"].lower())
+    if mime_type:
+        return {"mime_type": mime_type, "data": base_image["image"]}
+    pixmap = fitz.Pixmap(doc, xref)
+    if pixmap.n - pixmap.alpha >= 4:  # CMYK
+        pixmap = fitz.Pixmap(fitz.csRGB, pixmap)
+    return {"mime_type": "image/png", "data": pixmap.tobytes("png")}
+
+
+def extract_pdf_content(pdf_bytes, page_range="", batch_size=EXTRACTION_BATCH_PAGES, progress=None):
+    """
+    Extracts markdown text and embedded images from a PDF file, page batch by page batch.
+
+    PyMuPDF and pymupdf4llm are imported here rather than at module level so
+    that the app only pays their import cost once a PDF is uploaded. Images
+    are kept in their encoded form rather than decoded, and an image that
+    appears on several pages is stored once.
+
+    Args:
+        pdf_bytes (bytes): The content of the PDF file.
+        page_range (str, optional): The pages to extract, see parse_page_ranges.
+            Defaults to all pages.
+        batch_size (int, optional): The number of pages converted at a time.
+        progress (callable, optional): Called with the number of pages
+            extracted so far and the number of pages to extract.
+
+    Returns:
+        dict: The extracted markdown text ('md_text'), the images as Gemini
+              blobs with 'mime_type' and 'data' ('image_list'), the width and
+              height of each image ('image_sizes'), the 1-based page number of
+              each image ('image_pages'), the offset in the text at which each
+              extracted page starts ('page_offsets'), the 1-based number of
+              each extracted page ('page_numbers'), the number of pages in the
+              document ('page_count') and a hash of all extracted image bytes
+              ('images_hash').
+
+    Raises:
+        InvalidPageRangeError: If the page range is invalid for the document.
+    """
+    import fitz  # PyMuPDF
+    import pymupdf4llm
+    from pymupdf4llm.helpers.pymupdf_rag import IdentifyHeaders
+
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        pages = parse_page_ranges(page_range, doc.page_count)
+        # Heading levels come from font sizes across all selected pages, so
+        # they are identified once instead of differently in every batch.
+        header_info = IdentifyHeaders(doc, pages=pages)
+
+        page_texts = []
+        page_offsets = []
+        offset = 0
+        image_list = []
+        image_sizes = []
+        image_pages = []
+        images_by_xref = {}
+        images_hash = hashlib.sha256()
+
+        for batch_start in range(0, len(pages), batch_size):
+            batch = pages[batch_start:batch_start + batch_size]
+            for chunk in pymupdf4llm.to_markdown(doc, pages=batch, hdr_info=header_info, page_chunks=True):
+                page_offsets.append(offset)
+                offset += len(chunk["text"])
+                page_texts.append(chunk["text"])
+
+            for page_index in batch:
+                for img in doc[page_index].get_images(full=True):
+                    xref = img[0]
+                    if xref not in images_by_xref:
+                        base_image = doc.extract_image(xref)
+                        if not base_image:
+                            continue
+                        images_by_xref[xref] = (_image_blob(doc, xref, base_image), (base_image["width"], base_image["height"]))
+                    blob, size = images_by_xref[xref]
+                    images_hash.update(blob["data"])
+                    image_list.append(blob)
+                    image_sizes.append(size)
+                    image_pages.append(page_index + 1)
+
+            if progress:
+                progress(batch_start + len(batch), len(pages))
+
+        page_count = doc.page_count
+    finally:
+        doc.close()
+
+    return {
+        "md_text": "".join(page_texts),
+        "image_list": image_list,
+        "image_sizes": image_sizes,
+        "image_pages": image_pages,
+        "page_offsets": page_offsets,
+        "page_numbers": [page_index + 1 for page_index in pages],
+        "page_count": page_count,
+        "images_hash": images_hash.hexdigest()[:16],
+    }
+
+
+def page_number_at(page_offsets, offset, page_numbers=None):
+    """
+    Returns the 1-based page number containing the given text offset.
+
+    If only some pages were extracted, `page_numbers` maps each extracted
+    page to its number in the document.
+    """
+    index = max(bisect.bisect_right(page_offsets, offset), 1)
+    return page_numbers[index - 1] if page_numbers else index
+
+
+def split_sections(markdown_text, max_level=2):
+    """
+    Splits markdown text into sections at headings up to `max_level`.
+
+    Deeper headings stay inside their parent section. Text before the first
+    heading becomes a "Preamble" section.
+
+    Returns:
+        list: Dictionaries with the section 'title', 'level' and the 'start'
+              and 'end' offsets of the section in the text.
+    """
+    sections = []
+    title, level, start = "Preamble", 0, 0
+    offset = 0
+    for line in markdown_text.splitlines(keepends=True):
+        match = re.match(r'^(#{1,6})\s+(.+)', line.strip())
+        if match and len(match.group(1)) <= max_level:
+            if markdown_text[start:offset].strip():
+                sections.append({'title': title, 'level': level, 'start': start, 'end': offset})
+            title = match.group(2).strip().strip('*').strip()
+            level = len(match.group(1))
+            start = offset
+        offset += len(line)
+    if markdown_text[start:].strip():
+        sections.append({'title': title, 'level': level, 'start': start, 'end': len(markdown_text)})
+    return sections
+
 
 def extract_headings(markdown_text):
     """Extracts headings from markdown text for a table of contents."""
@@ -20,4 +209,4 @@ def create_sidebar_toc(headings):
         st.sidebar.markdown("## Table of Contents")
         for heading in headings:
             indent = "  " * (heading['level'] - 1)
-            st.sidebar.markdown(f"{indent}- [{heading['title']}](#{heading['anchor']})")
\ No newline at end of file
+            st.sidebar.markdown(f"{indent}- [{heading['title']}](#{heading['anchor']})")
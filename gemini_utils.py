@@ -1,6 +1,378 @@
+import hashlib
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future, FIRST_COMPLETED, wait
+from functools import partial
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import streamlit as st
-import google.generativeai as genai
-from prompts import GEMINI_MODEL, SUMMARIZE_PROMPT, ANALYZE_PROMPT, MERMAID_PROMPT, TRD_PROMPT, EPICS_USER_STORIES_PROMPT
+from prompts import GEMINI_MODEL, SUMMARIZE_PROMPT, SECTION_SUMMARY_PROMPT, ANALYZE_PROMPT, MERMAID_PROMPT, MERMAID_REPAIR_PROMPT, TRD_PROMPT, EPICS_USER_STORIES_PROMPT
+from mermaid_utils import repair_mermaid
+
+# Client resilience settings. Each can be overridden through the environment.
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "120"))  # per attempt
+GEMINI_DEADLINE_SECONDS = float(os.getenv("GEMINI_DEADLINE_SECONDS", "300"))  # across all retries
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_BACKOFF_SECONDS = float(os.getenv("GEMINI_BACKOFF_SECONDS", "1"))
+GEMINI_MAX_BACKOFF_SECONDS = float(os.getenv("GEMINI_MAX_BACKOFF_SECONDS", "20"))
+GEMINI_HEDGE_AFTER_SECONDS = float(os.getenv("GEMINI_HEDGE_AFTER_SECONDS", "0"))  # 0 disables hedging
+GEMINI_BREAKER_THRESHOLD = int(os.getenv("GEMINI_BREAKER_THRESHOLD", "5"))
+GEMINI_BREAKER_RESET_SECONDS = float(os.getenv("GEMINI_BREAKER_RESET_SECONDS", "60"))
+# How long a coalesced request waits for an identical in-flight call started by another session
+GEMINI_COALESCE_WAIT_SECONDS = float(os.getenv("GEMINI_COALESCE_WAIT_SECONDS", str(GEMINI_DEADLINE_SECONDS + 30)))
+
+
+class GeminiUnavailableError(Exception):
+    """Raised when the circuit breaker is open and requests fail fast."""
+
+
+class CircuitBreaker:
+    """
+    A thread-safe circuit breaker shared by every session in the process.
+
+    After `failure_threshold` consecutive retryable failures the circuit opens
+    and requests fail immediately. Once `reset_timeout` seconds have passed a
+    single trial request is let through; its outcome closes or re-opens the
+    circuit.
+    `clock` returns the current time in seconds and can be replaced in tests.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    def allow_request(self):
+        """Returns True if a request may be sent to the API."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial_in_flight or self._clock() - self._opened_at < self.reset_timeout:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                self._opened_at = self._clock()
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """Releases a half-open trial that ended with a non-retryable error."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def seconds_until_retry(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 0
+            return max(0, self.reset_timeout - (self._clock() - self._opened_at))
+
+
+class SharedRequestTimeoutError(TimeoutError):
+    """Raised when a caller gives up waiting for an identical in-flight request."""
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into a single call.
+
+    The first caller for a key (the leader) runs the call; callers arriving
+    while it is in flight wait for its result instead of making their own.
+    Errors are fanned out the same way. Nothing is cached once the call ends.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, timeout=None):
+        """
+        Runs `fn`, or waits up to `timeout` seconds for an identical in-flight call.
+
+        Returns:
+            tuple: The result of the call and whether it was shared from
+                   another caller's call (bool).
+
+        Raises:
+            SharedRequestTimeoutError: If a waiting caller's timeout expires first.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._calls[key] = future
+
+        if not is_leader:
+            try:
+                return future.result(timeout=timeout), True
+            # Before Python 3.11 the futures TimeoutError is not the builtin one
+            except (TimeoutError, FutureTimeoutError):
+                if future.done():
+                    raise  # The shared call itself timed out
+                raise SharedRequestTimeoutError(f"Gave up after waiting {timeout} seconds for an identical request.")
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+
+def _part_digest(part):
+    """Returns a digest of one prompt part: text, raw bytes, a blob dict or a PIL image."""
+    if isinstance(part, str):
+        return hashlib.sha256(part.encode("utf-8")).digest()
+    if isinstance(part, (bytes, bytearray)):
+        return hashlib.sha256(part).digest()
+    if isinstance(part, dict) and "data" in part:
+        return hashlib.sha256(part.get("mime_type", "").encode() + bytes(part["data"])).digest()
+    if hasattr(part, "tobytes"):
+        return hashlib.sha256(f"{part.mode}{part.size}".encode() + part.tobytes()).digest()
+    return hashlib.sha256(repr(part).encode("utf-8")).digest()
+
+
+def request_key(model_name, prompt_parts):
+    """Returns the coalescing key of a request: a hash of the model name and every prompt part."""
+    digest = hashlib.sha256(model_name.encode("utf-8"))
+    for part in prompt_parts:
+        digest.update(_part_digest(part))
+    return digest.hexdigest()
+
+
+def _is_retryable(error):
+    """Returns True for errors worth retrying: timeouts, rate limits and server-side failures."""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    try:
+        from google.api_core import exceptions as api_exceptions
+    except ImportError:
+        return False
+    return isinstance(error, (
+        api_exceptions.DeadlineExceeded,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.InternalServerError,
+        api_exceptions.TooManyRequests,
+        api_exceptions.ResourceExhausted,
+        api_exceptions.Aborted,
+    ))
+
+
+class GeminiClient:
+    """
+    A Gemini client shared across reruns and sessions.
+
+    The GenerativeModel instance is created once and reused. Every attempt
+    carries a timeout, retryable errors are retried with exponential backoff
+    and full jitter within an overall deadline, and an optional hedged request
+    is sent when the first one has not answered after `hedge_after` seconds.
+    The tokens of a hedged call that loses the race are passed to
+    `on_hedge_usage`, since no caller is charged for them. Identical requests
+    made concurrently by different sessions share a single call.
+    """
+
+    def __init__(self, model_name=GEMINI_MODEL, timeout=GEMINI_TIMEOUT_SECONDS,
+                 deadline=GEMINI_DEADLINE_SECONDS, max_retries=GEMINI_MAX_RETRIES,
+                 hedge_after=GEMINI_HEDGE_AFTER_SECONDS, breaker=None, on_hedge_usage=None):
+        self.model_name = model_name
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.hedge_after = hedge_after
+        self.on_hedge_usage = on_hedge_usage
+        self.breaker = breaker or CircuitBreaker(GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_RESET_SECONDS)
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._single_flight = SingleFlight()
+
+    @property
+    def model(self):
+        with self._model_lock:
+            if self._model is None:
+                import google.generativeai as genai
+                configure_gemini(os.getenv("GOOGLE_API_KEY"))
+                self._model = genai.GenerativeModel(model_name=self.model_name)
+            return self._model
+
+    def generate(self, prompt_parts, wait_timeout=GEMINI_COALESCE_WAIT_SECONDS):
+        """
+        Generates content for the given prompt parts.
+
+        If an identical request (same model and parts) is already in flight,
+        its result is shared instead of making another call. Token usage is
+        attributed once: to the caller that made the call. Callers that
+        shared the result get zero token counts and 'shared' set to True.
+
+        Args:
+            prompt_parts (list): The prompt, text and image parts to send.
+            wait_timeout (float, optional): How long to wait for a shared call.
+
+        Returns:
+            tuple: The generated text (str) and a dictionary with token usage information.
+
+        Raises:
+            GeminiUnavailableError: If the circuit breaker is open.
+            SharedRequestTimeoutError: If a shared call did not finish within `wait_timeout`.
+            Exception: The last error if the request could not be completed.
+        """
+        key = request_key(self.model_name, prompt_parts)
+        (text, token_info), shared = self._single_flight.do(key, lambda: self._generate(prompt_parts), wait_timeout)
+        if shared:
+            token_info = {"prompt": 0, "output": 0, "total": 0}
+        return text, {**token_info, "shared": shared}
+
+    def _generate(self, prompt_parts):
+        if not self.breaker.allow_request():
+            raise GeminiUnavailableError(
+                "Gemini is currently unavailable after repeated failures. "
+                f"Please try again in {self.breaker.seconds_until_retry():.0f} seconds."
+            )
+
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            remaining = self.deadline - (time.monotonic() - started)
+            try:
+                response = self._send(prompt_parts, min(self.timeout, max(remaining, 1)))
+                text = response.text
+                token_info = self._token_info(response, prompt_parts, text)
+            except Exception as e:
+                if not _is_retryable(e):
+                    self.breaker.release_trial()
+                    raise
+                self.breaker.record_failure()
+                delay = random.uniform(0, min(GEMINI_MAX_BACKOFF_SECONDS, GEMINI_BACKOFF_SECONDS * 2 ** attempt))
+                attempt += 1
+                out_of_time = time.monotonic() - started + delay >= self.deadline
+                if attempt > self.max_retries or out_of_time or not self.breaker.allow_request():
+                    raise
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            return text, token_info
+
+    def _send(self, prompt_parts, timeout):
+        if self.hedge_after <= 0:
+            return self._call(prompt_parts, timeout)
+
+        primary = self._start_call(prompt_parts, timeout)
+        # The hedge delay counts from when the call is sent, not when it was queued
+        primary.started.wait()
+        done, _ = wait([primary], timeout=self.hedge_after)
+        if done:
+            return primary.result()
+
+        # The primary is slow: race it against a hedged duplicate. The loser
+        # cannot be cancelled mid-flight, so it is left to finish and its
+        # tokens are reported once it does.
+        pending = {primary, self._start_call(prompt_parts, timeout)}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winners = [future for future in done if future.exception() is None]
+            if winners:
+                for loser in (done | pending) - {winners[0]}:
+                    loser.add_done_callback(partial(self._report_hedge_usage, prompt_parts))
+                return winners[0].result()
+            error = next(iter(done)).exception()
+        raise error
+
+    def _start_call(self, prompt_parts, timeout):
+        """
+        Sends a call on a thread of its own, so concurrent hedged requests are
+        never queued behind each other. The returned future's `started` event
+        is set once the call is sent.
+        """
+        future = Future()
+        future.started = threading.Event()
+
+        def run():
+            future.set_running_or_notify_cancel()
+            future.started.set()
+            try:
+                future.set_result(self._call(prompt_parts, timeout))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name="gemini-hedge", daemon=True).start()
+        return future
+
+    def _report_hedge_usage(self, prompt_parts, future):
+        if self.on_hedge_usage is None or future.exception() is not None:
+            return
+        response = future.result()
+        try:
+            token_info = self._token_info(response, prompt_parts, response.text)
+        except Exception:
+            return  # e.g. a blocked response, which has no text
+        self.on_hedge_usage(token_info)
+
+    def _call(self, prompt_parts, timeout):
+        return self.model.generate_content(prompt_parts, request_options={"timeout": timeout})
+
+    def _token_info(self, response, prompt_parts, text):
+        usage = getattr(response, "usage_metadata", None)
+        if usage and usage.total_token_count:
+            prompt_tokens = usage.prompt_token_count
+            total_tokens = usage.total_token_count
+        else:
+            prompt_tokens = self.model.count_tokens(prompt_parts).total_tokens
+            total_tokens = prompt_tokens + self.model.count_tokens(text).total_tokens
+        # The total includes thinking tokens, which are billed as output
+        # but are not part of candidates_token_count
+        return {
+            "prompt": prompt_tokens,
+            "output": total_tokens - prompt_tokens,
+            "total": total_tokens,
+        }
+
+
+@st.cache_resource(show_spinner=False)
+def configure_gemini(api_key):
+    """
+    Configures the Gemini SDK once per process.
+
+    google.generativeai is imported lazily on the first generation request
+    because it pulls in gRPC and protobuf, which dominate the app's cold start.
+    Caching the call as a resource means reruns and new sessions reuse the
+    already configured SDK.
+
+    Args:
+        api_key (str): The Google API key.
+    """
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+
+
+def _record_hedge_usage(token_info):
+    """Records the tokens of a hedged call that lost the race in the usage ledger."""
+    from budget_utils import get_usage_ledger
+    get_usage_ledger().record("hedge", token_info)
+
+
+@st.cache_resource(show_spinner=False)
+def get_gemini_client(model_name=GEMINI_MODEL):
+    """Returns the process-wide GeminiClient for the given model."""
+    return GeminiClient(model_name=model_name, on_hedge_usage=_record_hedge_usage)
 
 
 def _generate_content_with_gemini(prompt, text_content, image_list=None):
@@ -10,7 +382,7 @@ def _generate_content_with_gemini(prompt, text_content, image_list=None):
     Args:
         prompt (str): The prompt to use for generation.
         text_content (str): The text content to use.
-        image_list (list, optional): A list of PIL Image objects. Defaults to None.
+        image_list (list, optional): Images as blobs with 'mime_type' and 'data', or PIL Image objects. Defaults to None.
 
     Returns:
         tuple: A tuple containing the generated content (str) and a dictionary
@@ -19,24 +391,21 @@ def _generate_content_with_gemini(prompt, text_content, image_list=None):
     if not text_content:
         return None, None
 
-    model = genai.GenerativeModel(model_name=GEMINI_MODEL)
-
     prompt_parts = [prompt, text_content]
     if image_list:
         prompt_parts.extend(image_list)
 
     try:
-        response = model.generate_content(prompt_parts)
-        
-        prompt_tokens = model.count_tokens(prompt_parts).total_tokens
-        output_tokens = model.count_tokens(response.text).total_tokens
-        
-        token_info = {
-            "prompt": prompt_tokens,
-            "output": output_tokens,
-            "total": prompt_tokens + output_tokens,
-        }
-        return response.text, token_info
+        response_text, token_info = get_gemini_client().generate(prompt_parts)
+        if token_info["shared"]:
+            st.toast("Reused the result of an identical request already in progress. No extra tokens were used.")
+        return response_text, token_info
+    except GeminiUnavailableError as e:
+        st.error(str(e))
+        return None, None
+    except SharedRequestTimeoutError:
+        st.error("Timed out waiting for an identical request from another session to finish.")
+        return None, None
     except Exception as e:
         st.error(f"An error occurred during content generation: {e}")
         return None, None
@@ -48,7 +417,7 @@ def summarize_text(text_content, image_list=None):
 
     Args:
         text_content (str): The text content to summarize.
-        image_list (list, optional): A list of PIL Image objects. Defaults to None.
+        image_list (list, optional): Images as blobs with 'mime_type' and 'data', or PIL Image objects. Defaults to None.
 
     Returns:
         tuple: A tuple containing the generated summary (str) and a dictionary
@@ -57,13 +426,28 @@ def summarize_text(text_content, image_list=None):
     return _generate_content_with_gemini(SUMMARIZE_PROMPT, text_content, image_list)
     
 
+def summarize_section(text_content, image_list=None):
+    """
+    Generates a short summary of a single section (chunk) of a business plan.
+
+    Args:
+        text_content (str): The text of the section.
+        image_list (list, optional): Images as blobs with 'mime_type' and 'data', or PIL Image objects. Defaults to None.
+
+    Returns:
+        tuple: A tuple containing the section summary (str) and a dictionary
+               with token usage information, or (None, None) if an error occurs.
+    """
+    return _generate_content_with_gemini(SECTION_SUMMARY_PROMPT, text_content, image_list)
+
+
 def analyze_with_gemini(text_content, image_list=None):
     """
     Analyzes the given text and images using the Gemini model.
 
     Args:
         text_content (str): The text content to analyze.
-        image_list (list, optional): A list of PIL Image objects. Defaults to None.
+        image_list (list, optional): Images as blobs with 'mime_type' and 'data', or PIL Image objects. Defaults to None.
 
     Returns:
         tuple: A tuple containing the analysis result (str) and a dictionary
@@ -76,20 +460,36 @@ def generate_mermaid_req_doc(text_content, image_list=None):
     """
     Generates a Mermaid diagram documentation based on the given text and images.
 
+    The diagram is validated and repaired locally. Only if it cannot be
+    repaired is the model asked to fix it, and that retry sends just the
+    broken diagram rather than the business plan again.
+
     Args:
         text_content (str): The text content for the diagram.
-        image_list (list, optional): A list of PIL Image objects. Defaults to None.
+        image_list (list, optional): Images as blobs with 'mime_type' and 'data', or PIL Image objects. Defaults to None.
 
     Returns:
         tuple: A tuple containing the generated Mermaid code (str) and a dictionary
                with token usage information, or (None, None) if an error occurs.
     """
     response_text, token_info = _generate_content_with_gemini(MERMAID_PROMPT, text_content, image_list)
-    if response_text:
-        # Clean up the response to ensure it's valid Mermaid code
-        cleaned_response = response_text.strip().replace("```mermaid", "").replace("```", "").strip()
-        return cleaned_response, token_info
-    return None, None
+    if not response_text:
+        return None, None
+
+    mermaid_code, problems = repair_mermaid(response_text)
+    if not problems:
+        return mermaid_code, token_info
+
+    repair_prompt = MERMAID_REPAIR_PROMPT.replace("{problems}", "\n".join(f"- {problem}" for problem in problems))
+    retry_text, retry_token_info = _generate_content_with_gemini(repair_prompt, response_text)
+    if retry_text:
+        token_info = {**token_info, **{key: token_info[key] + retry_token_info[key] for key in ("prompt", "output", "total")}}
+        mermaid_code, problems = repair_mermaid(retry_text)
+        if not problems:
+            return mermaid_code, token_info
+
+    st.error("The generated system architecture diagram is invalid and could not be repaired: " + " ".join(problems))
+    return None, token_info
 
 
 def generate_trd_content(text_content, image_list=None):
@@ -98,7 +498,7 @@ def generate_trd_content(text_content, image_list=None):
 
     Args:
         text_content (str): The text content for the TRD.
-        image_list (list, optional): A list of PIL Image objects. Defaults to None.
+        image_list (list, optional): Images as blobs with 'mime_type' and 'data', or PIL Image objects. Defaults to None.
 
     Returns:
         tuple: A tuple containing the generated TRD content (str) and a dictionary
@@ -112,7 +512,7 @@ def generate_epics_and_user_stories(text_content, image_list=None):
 
     Args:
         text_content (str): The text content for generating epics and user stories.
-        image_list (list, optional): A list of PIL Image objects. Defaults to None.
+        image_list (list, optional): Images as blobs with 'mime_type' and 'data', or PIL Image objects. Defaults to None.
 
     Returns:
         tuple: A tuple containing the generated epics and user stories (str) and a dictionary
@@ -0,0 +1,352 @@
+"""
+Multi-session load test for the BA Agent Streamlit app.
+
+Drives N simulated sessions through upload -> summarize -> analyze -> TRD ->
+download using Streamlit's AppTest harness, all inside one process like a
+single app replica. Gemini and the mermaid.ink diagram renderer are replaced
+with fakes that answer after a configurable latency, so the test measures the
+app itself and costs no tokens.
+
+Reports throughput, per-action latency percentiles and peak RSS per session,
+for sizing replicas and catching scaling regressions.
+
+Usage:
+    python loadtest.py --sessions 20 --concurrency 5 --pages 40
+    python loadtest.py --sessions 10 --pdf business_plan.pdf --json results.json
+"""
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_FILE = os.path.join(APP_DIR, "ba-agent.py")
+sys.path.insert(0, APP_DIR)
+
+ACTIONS = ["upload", "summarize", "analyze", "trd", "download"]
+
+_FAKE_MERMAID = "graph TD\n    A[User] --> B[Web App]\n    B --> C[API]\n    C --> D[(Database)]"
+_FAKE_EPICS = (
+    "## Epic: Onboarding\n**Description:** Let users sign up.\n\n"
+    "| User Story | Description | Acceptance Criteria |\n| --- | --- | --- |\n"
+    "| Sign up | As a user, I want to sign up so that I can use the app. | - Given a form, when I submit it, then I have an account. |\n"
+)
+
+
+class FakeUsage:
+    def __init__(self, prompt_tokens, output_tokens):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+
+
+class FakeResponse:
+    def __init__(self, text, prompt_tokens):
+        self.text = text
+        self.usage_metadata = FakeUsage(prompt_tokens, len(text) // 4)
+
+
+class FakeUpload:
+    """Stands in for Streamlit's UploadedFile."""
+
+    def __init__(self, name, data, file_id):
+        self.name = name
+        self.file_id = file_id
+        self._data = data
+
+    def getvalue(self):
+        return self._data
+
+
+def _sleep_around(seconds):
+    if seconds > 0:
+        time.sleep(random.uniform(seconds * 0.5, seconds * 1.5))
+
+
+def install_fakes(gemini_latency, render_latency, output_chars):
+    """Replaces Gemini, mermaid.ink and the file uploader with in-process fakes."""
+    import streamlit as st
+    import gemini_utils
+    import docx_utils
+    from PIL import Image
+
+    def fake_call(client, prompt_parts, timeout):
+        _sleep_around(gemini_latency)
+        prompt = prompt_parts[0]
+        prompt_tokens = sum(len(part) for part in prompt_parts if isinstance(part, str)) // 4
+        if "Mermaid" in prompt:
+            return FakeResponse(_FAKE_MERMAID, prompt_tokens)
+        if "Product Owner" in prompt:
+            return FakeResponse(_FAKE_EPICS, prompt_tokens)
+        return FakeResponse("# Result\n\n" + "Lorem ipsum dolor sit amet. " * (output_chars // 28), prompt_tokens)
+
+    png = io.BytesIO()
+    Image.new("RGB", (800, 400), (255, 255, 255)).save(png, format="PNG")
+    png_bytes = png.getvalue()
+
+    def fake_render(mermaid_code):
+        _sleep_around(render_latency)
+        return png_bytes
+
+    def fake_file_uploader(*args, **kwargs):
+        # Each AppTest session carries its own uploads in its session state
+        return st.session_state.get("_loadtest_uploads", [])
+
+    gemini_utils.GeminiClient._call = fake_call
+    docx_utils._fetch_mermaid_ink = fake_render
+    st.file_uploader = fake_file_uploader
+
+
+def share_test_runtime():
+    """
+    Lets several AppTest sessions run concurrently.
+
+    AppTest installs a mock Runtime as a process-wide singleton for each run
+    and clears it when the run ends, which breaks any other session still
+    running. Keeping the most recent mock available, like the single Runtime
+    of a real app replica, avoids that race.
+    """
+    from streamlit.runtime import Runtime
+
+    latest = []
+
+    def instance(cls):
+        if cls._instance is not None:
+            latest[:] = [cls._instance]
+            return cls._instance
+        if latest:
+            return latest[0]
+        raise RuntimeError("Runtime hasn't been created!")
+
+    def exists(cls):
+        return cls._instance is not None or bool(latest)
+
+    Runtime.instance = classmethod(instance)
+    Runtime.exists = classmethod(exists)
+
+
+def make_sample_pdf(pages, tag):
+    """Generates a business-plan-like PDF with headings, tables, footers and a few images."""
+    import fitz  # PyMuPDF
+    from PIL import Image
+
+    topics = ["Executive Summary", "Market Analysis", "Technology Platform", "Operations",
+              "Financial Projections", "Marketing Strategy", "Management Team", "Risks"]
+    image = io.BytesIO()
+    Image.new("RGB", (600, 300), (30, 90, 160)).save(image, format="PNG")
+
+    doc = fitz.open()
+    for i in range(pages):
+        page = doc.new_page()
+        topic = topics[i % len(topics)]
+        page.insert_text((72, 40), f"Sample Business Plan {tag} - Confidential", fontsize=9)
+        page.insert_text((72, 80), topic, fontsize=20)
+        y = 110
+        for line in range(30):
+            page.insert_text((72, y), f"{topic} {tag}: detail {line} about customers, platform, revenue and operations.", fontsize=10)
+            y += 15
+        if i % 5 == 2:
+            page.insert_image(fitz.Rect(72, 580, 372, 730), stream=image.getvalue())
+        page.insert_text((280, 800), f"Page {i + 1} of {pages}", fontsize=9)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+class RssMonitor:
+    """Samples the process's resident set size in the background and keeps the peak."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = current_rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+
+
+def current_rss():
+    """Returns the current resident set size in bytes."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # No /proc (macOS): fall back to the peak, reported in bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def approx_size(obj):
+    """Roughly estimates the memory held by session state values, including decoded images."""
+    if isinstance(obj, dict):
+        return sum(approx_size(k) + approx_size(v) for k, v in obj.items())
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        return sum(approx_size(item) for item in obj)
+    if isinstance(obj, str):
+        return len(obj.encode("utf-8", "ignore"))
+    if isinstance(obj, (bytes, bytearray)):
+        return len(obj)
+    if hasattr(obj, "nbytes"):  # NumPy arrays
+        return int(obj.nbytes)
+    if hasattr(obj, "getbands") and hasattr(obj, "size"):  # PIL images
+        return obj.size[0] * obj.size[1] * len(obj.getbands())
+    return sys.getsizeof(obj)
+
+
+def run_session(index, file_name, pdf_bytes, timeout):
+    """Runs one simulated user session and returns its action timings and errors."""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_FILE, default_timeout=timeout)
+    at.session_state["_loadtest_uploads"] = [FakeUpload(file_name, pdf_bytes, f"session-{index}")]
+    result = {"session": index, "timings": {}, "errors": []}
+
+    def step(action, run):
+        started = time.perf_counter()
+        run()
+        result["timings"][action] = time.perf_counter() - started
+        result["errors"].extend(f"{action}: {e.value}" for e in at.exception)
+        result["errors"].extend(f"{action}: {e.value}" for e in at.error)
+
+    try:
+        step("upload", at.run)
+        step("summarize", lambda: at.button(key=f"summary_{file_name}").click().run())
+        step("analyze", lambda: at.button(key=f"analyze_{file_name}").click().run())
+        step("trd", lambda: at.button(key=f"trd_{file_name}").click().run())
+        # Download buttons cannot be clicked in AppTest; a plain rerun measures
+        # rendering the page with the Word document built for download.
+        step("download", at.run)
+        if not at.get("download_button"):
+            result["errors"].append("download: no download button was rendered")
+        result["state_bytes"] = approx_size(dict(at.session_state["files"]))
+    except Exception as e:
+        result["errors"].append(f"{type(e).__name__}: {e}")
+    return result
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(share * (len(ordered) - 1))))]
+
+
+def summarize_results(results, wall_time, baseline_rss, peak_rss, concurrency):
+    completed = [r for r in results if not r["errors"]]
+    actions = sum(len(r["timings"]) for r in results)
+    report = {
+        "sessions": len(results),
+        "completed": len(completed),
+        "failed": len(results) - len(completed),
+        "wall_time_s": wall_time,
+        "sessions_per_min": len(completed) / wall_time * 60 if wall_time else 0,
+        "actions_per_s": actions / wall_time if wall_time else 0,
+        "latency_ms": {},
+        "baseline_rss_mb": baseline_rss / 2 ** 20,
+        "peak_rss_mb": peak_rss / 2 ** 20,
+        "peak_rss_per_session_mb": (peak_rss - baseline_rss) / 2 ** 20 / max(1, min(concurrency, len(results))),
+        "session_state_mb": statistics.mean(r.get("state_bytes", 0) for r in results) / 2 ** 20 if results else 0,
+        "errors": [error for r in results for error in r["errors"]][:20],
+    }
+    for action in ACTIONS:
+        values = [r["timings"][action] * 1000 for r in results if action in r["timings"]]
+        if values:
+            report["latency_ms"][action] = {
+                "count": len(values),
+                "p50": percentile(values, 0.50),
+                "p90": percentile(values, 0.90),
+                "p95": percentile(values, 0.95),
+                "p99": percentile(values, 0.99),
+                "max": max(values),
+            }
+    return report
+
+
+def print_report(report, args):
+    print(f"Sessions: {report['sessions']} (concurrency {args.concurrency}), "
+          f"completed {report['completed']}, failed {report['failed']}")
+    print(f"Wall time: {report['wall_time_s']:.1f} s | throughput: {report['sessions_per_min']:.1f} sessions/min, "
+          f"{report['actions_per_s']:.2f} actions/s")
+    print(f"{'Action':<10} {'count':>6} {'p50 ms':>9} {'p90 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for action, stats in report["latency_ms"].items():
+        print(f"{action:<10} {stats['count']:>6} {stats['p50']:>9.0f} {stats['p90']:>9.0f} "
+              f"{stats['p95']:>9.0f} {stats['p99']:>9.0f} {stats['max']:>9.0f}")
+    print(f"RSS: baseline {report['baseline_rss_mb']:.0f} MB, peak {report['peak_rss_mb']:.0f} MB, "
+          f"~{report['peak_rss_per_session_mb']:.1f} MB per concurrent session")
+    print(f"Session state: ~{report['session_state_mb']:.1f} MB per session")
+    for error in report["errors"]:
+        print(f"  error: {error}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=10, help="Number of simulated sessions.")
+    parser.add_argument("--concurrency", type=int, default=5, help="Sessions running at the same time.")
+    parser.add_argument("--pdf", help="PDF to upload. Defaults to a generated sample business plan.")
+    parser.add_argument("--pages", type=int, default=20, help="Pages of the generated sample PDF.")
+    parser.add_argument("--same-doc", action="store_true",
+                        help="Upload the identical document in every session (lets identical requests be coalesced).")
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="Mean fake Gemini latency in seconds.")
+    parser.add_argument("--render-latency", type=float, default=0.3, help="Mean fake mermaid.ink latency in seconds.")
+    parser.add_argument("--output-chars", type=int, default=4000, help="Characters in each fake Gemini answer.")
+    parser.add_argument("--warmup", type=int, default=1, help="Sessions to run first, excluded from the results.")
+    parser.add_argument("--timeout", type=float, default=600, help="Per-action timeout in seconds.")
+    parser.add_argument("--json", help="Also write the report as JSON to this path.")
+    args = parser.parse_args()
+
+    os.environ.setdefault("GOOGLE_API_KEY", "loadtest-dummy-key")
+    # Keep the fake usage out of the real usage ledger
+    ledger_fd, ledger_path = tempfile.mkstemp(prefix="loadtest_ledger_", suffix=".jsonl")
+    os.close(ledger_fd)
+    os.environ["USAGE_LEDGER_PATH"] = ledger_path
+    install_fakes(args.gemini_latency, args.render_latency, args.output_chars)
+    share_test_runtime()
+
+    if args.pdf:
+        with open(args.pdf, "rb") as f:
+            shared_pdf = f.read()
+    else:
+        shared_pdf = make_sample_pdf(args.pages, "shared")
+
+    def document_for(index):
+        if args.same_doc or args.pdf:
+            return os.path.basename(args.pdf) if args.pdf else "sample_plan.pdf", shared_pdf
+        return f"sample_plan_{index}.pdf", make_sample_pdf(args.pages, f"session {index}")
+
+    for i in range(args.warmup):
+        run_session(-1 - i, *document_for(-1 - i), args.timeout)
+
+    documents = [document_for(i) for i in range(args.sessions)]
+    baseline_rss = current_rss()
+    started = time.perf_counter()
+    with RssMonitor() as monitor, ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [pool.submit(run_session, i, name, data, args.timeout) for i, (name, data) in enumerate(documents)]
+        results = [future.result() for future in futures]
+    wall_time = time.perf_counter() - started
+
+    report = summarize_results(results, wall_time, baseline_rss, monitor.peak, args.concurrency)
+    print_report(report, args)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    os.remove(ledger_path)
+
+
+if __name__ == "__main__":
+    main()
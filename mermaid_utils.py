@@ -0,0 +1,178 @@
+# mermaid_utils.py
+import re
+
+# Node shapes: opening delimiter -> closing delimiter, longest openers first.
+_SHAPES = [
+    ("([", "])"), ("[[", "]]"), ("[(", ")]"), ("((", "))"), ("{{", "}}"),
+    ("[/", "/]"), ("[\\", "\\]"), ("[", "]"), ("(", ")"), ("{", "}"), (">", "]"),
+]
+_HEADER = re.compile(r'^(?:graph|flowchart)\s+(TD|TB|BT|LR|RL)\b', re.IGNORECASE)
+_ARROW = re.compile(r'\s*(<?(?:-->|---|-\.->|-\.-|==>|===|--[xo]))\s*(?:\|([^|]*)\|)?\s*')
+# Edge text written between the arrow halves, as in `A -- text --> B` or `A-- text -->B`
+_TEXT_ARROW = re.compile(r'\s*(--|==|-\.)\s+([^|>\-=.\s][^|>]*?)\s+(-->|---|==>|-\.->)\s*')
+_ARROW_TOKEN = re.compile(r'--|==|-\.')
+_STYLE_STATEMENT = re.compile(r'^(?:classDef|class|style|linkStyle|click)\b')
+_RESERVED_IDS = {"end", "graph", "subgraph", "flowchart"}
+
+
+def clean_label(label):
+    """Removes characters that break Mermaid node and edge labels, such as parentheses and brackets."""
+    label = re.sub(r'[()\[\]{}<>"|;`]', '', label)
+    return " ".join(label.split())
+
+
+def _clean_node_id(node_id):
+    cleaned = re.sub(r'\W', '_', node_id.strip())
+    if cleaned.lower() in _RESERVED_IDS:
+        cleaned += "_"
+    return cleaned
+
+
+def _parse_node(segment, allow_bare_text=False):
+    """
+    Parses a node reference such as `A`, `A[Label]` or `A((Label))` into (id, opener, closer, label).
+
+    With `allow_bare_text`, plain text such as `Payment Gateway` is accepted
+    as a node whose label is the text itself.
+    """
+    segment = segment.strip().rstrip(';').strip()
+    match = re.match(r'^([^\s\[\](){}>]+)\s*(.*)$', segment)
+    if not match:
+        return None
+    node_id, rest = match.groups()
+    if _ARROW_TOKEN.search(node_id):
+        # Part of an arrow that was not recognised, not a node
+        return None
+    if not rest:
+        return node_id, None, None, None
+    for opener, closer in _SHAPES:
+        if rest.startswith(opener):
+            label = rest[len(opener):]
+            # Labels with stray brackets are the most common breakage, so the
+            # label runs to the last closing delimiter instead of the first.
+            if label.endswith(closer):
+                label = label[:-len(closer)]
+            elif label and label[-1] in ")]}":
+                label = label[:-1]
+            return node_id, opener, closer, label
+    if allow_bare_text and not re.search(r'[\[\](){}>]', segment):
+        return segment, "[", "]", segment
+    return None
+
+
+def _parse_statement(line):
+    """Parses a node or edge statement into nodes and edges, or returns None if it is not one."""
+    line = _TEXT_ARROW.sub(lambda m: f" {m.group(3)}|{m.group(2)}| ", f" {line} ").strip()
+    parts = _ARROW.split(line)
+    # _ARROW has two groups, so parts alternates: nodes, arrow, edge label, nodes, ...
+    node_groups = parts[0::3]
+    arrows = parts[1::3]
+    edge_labels = parts[2::3]
+
+    groups = []
+    for group in node_groups:
+        nodes = [_parse_node(segment, allow_bare_text=bool(arrows)) for segment in group.split('&')]
+        if not group.strip() or any(node is None for node in nodes):
+            return None
+        groups.append(nodes)
+
+    edges = []
+    for i, arrow in enumerate(arrows):
+        for source in groups[i]:
+            for target in groups[i + 1]:
+                edges.append((source[0], arrow, edge_labels[i], target[0]))
+    return [node for nodes in groups for node in nodes], edges
+
+
+def repair_mermaid(mermaid_code):
+    """
+    Parses a `graph TD` Mermaid diagram, validates it and repairs what it can.
+
+    Repairs applied:
+    - code fences, prose and style statements around or inside the diagram are removed
+    - a missing `graph TD` header is added
+    - node IDs are made safe (no spaces, punctuation or reserved words)
+    - node and edge labels are sanitized, e.g. parentheses are removed
+    - each node keeps the label it was first given and duplicate edges are dropped
+    - unbalanced `subgraph`/`end` blocks are closed or their stray `end`s removed
+
+    Args:
+        mermaid_code (str): The Mermaid code as returned by the model.
+
+    Returns:
+        tuple: The repaired Mermaid code (str) and a list of problems that
+               could not be repaired (empty if the diagram is valid).
+    """
+    lines = mermaid_code.replace("```mermaid", "").replace("```", "").strip().splitlines()
+
+    header = "graph TD"
+    output = []
+    problems = []
+    defined = set()
+    seen_edges = set()
+    open_subgraphs = 0
+    edge_count = 0
+
+    for raw_line in lines:
+        line = raw_line.strip()
+        if not line or line.startswith("%%") or _STYLE_STATEMENT.match(line):
+            continue
+        if _HEADER.match(line):
+            header = f"graph {_HEADER.match(line).group(1).upper()}"
+            continue
+        if line.startswith("subgraph"):
+            title = clean_label(line[len("subgraph"):].strip().strip('[]"')) or f"Group {open_subgraphs + 1}"
+            output.append(f"subgraph {_clean_node_id(title)}[{title}]")
+            open_subgraphs += 1
+            continue
+        if line == "end":
+            if open_subgraphs:
+                output.append("end")
+                open_subgraphs -= 1
+            continue
+        if line.lower().startswith("direction "):
+            output.append(line)
+            continue
+
+        parsed = _parse_statement(line)
+        if parsed is None:
+            # Prose mixed into the diagram is dropped, but an edge that cannot
+            # be parsed would silently lose part of the diagram.
+            if _ARROW_TOKEN.search(line):
+                problems.append(f"Could not parse the line: {line}")
+            continue
+        nodes, edges = parsed
+
+        rendered = {}
+        for node_id, opener, closer, label in nodes:
+            clean_id = _clean_node_id(node_id)
+            if opener and clean_id not in defined and clean_label(label):
+                rendered[node_id] = f"{clean_id}{opener}{clean_label(label)}{closer}"
+                defined.add(clean_id)
+            else:
+                rendered.setdefault(node_id, clean_id)
+
+        if not edges:
+            definitions = [text for node_id, text in rendered.items() if text != _clean_node_id(node_id)]
+            output.extend(definitions)
+            continue
+
+        for source, arrow, edge_label, target in edges:
+            key = (_clean_node_id(source), arrow, clean_label(edge_label or ""), _clean_node_id(target))
+            if key in seen_edges:
+                continue
+            seen_edges.add(key)
+            edge_count += 1
+            label_part = f"|{key[2]}|" if key[2] else ""
+            # Each node's definition is rendered the first time it is used.
+            source_text = rendered.pop(source, key[0])
+            target_text = rendered.pop(target, key[3])
+            output.append(f"{source_text} {arrow}{label_part} {target_text}")
+
+    output.extend(["end"] * open_subgraphs)
+
+    if not edge_count and not defined:
+        problems.append("The diagram contains no nodes or edges.")
+
+    repaired = "\n".join([header] + [f"    {line}" for line in output])
+    return repaired, problems
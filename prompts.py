@@ -11,6 +11,16 @@ Business Plan Text:
 {md_text}
 """
 
+SECTION_SUMMARY_PROMPT = """
+Please provide a concise summary of the following sections of a business plan.
+Focus on the key points, objectives, strategies and any figures or numbers.
+Summarize each section in one short paragraph or a few bullet points, in the order given.
+If images are attached instead of text, summarize what the images show.
+
+Business Plan Section:
+{md_text}
+"""
+
 ANALYZE_PROMPT = """
 As a business analyst, analyze the provided business plan.
 Provide a concise analysis covering:
@@ -37,6 +47,21 @@ Business Plan:
 {md_text}
 """
 
+MERMAID_REPAIR_PROMPT = """
+The following Mermaid.js diagram is invalid and cannot be rendered.
+Fix it so that it is a valid top-down (`graph TD`) diagram that keeps the same components and connections.
+- Output ONLY raw Mermaid.js code using standard Mermaid syntax like `id[Description]`.
+- Node IDs must contain only letters, digits and underscores.
+- The text inside the node brackets MUST NOT contain any parentheses or brackets.
+- No explanations, markdown fences, custom styles, or link labels.
+
+Problems found:
+{problems}
+
+Invalid diagram:
+{md_text}
+"""
+
 TRD_PROMPT = """
 As a senior business analyst, create a comprehensive Technical Requirements Document (TRD) in Markdown format based on the provided business plan. The entire output must be a single, valid Markdown document. **Do not wrap the output in markdown code fences (```).**
 
@@ -100,4 +125,13 @@ Follow this structure precisely. For each epic, create a Markdown table with use
 
 **Business Plan Content:**
 {md_text}
-"""
\ No newline at end of file
+"""
+# Keyword queries used to pick the sections of a business plan that are most
+# relevant to each prompt when only relevant sections are sent.
+RETRIEVAL_QUERIES = {
+    "summary": "executive summary overview mission vision objectives goals strategy business model revenue market customers",
+    "analysis": "executive summary business model market analysis competition strategy revenue pricing financial projections costs risks marketing sales operations management team",
+    "mermaid": "technology platform architecture system components software application website mobile app integration api data database infrastructure cloud operations workflow process users customers suppliers payment",
+    "trd": "technology platform system features functionality requirements users roles customers interface screens data security performance scalability integration operations process workflow compliance",
+    "epics": "features functionality customers users roles services products journey workflow process ordering booking payment onboarding support operations requirements",
+}
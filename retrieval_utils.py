@@ -0,0 +1,194 @@
+# retrieval_utils.py
+import math
+import re
+from collections import Counter
+from extraction_utils import split_sections, page_number_at
+from compression_utils import compress_markdown, estimate_tokens, find_page_edge_lines
+from prompts import RETRIEVAL_QUERIES
+
+# Sections longer than this are split at paragraph boundaries so that a
+# single long chapter does not use up the whole token budget.
+CHUNK_MAX_CHARS = 4000
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in is it its of on or that the this to was were will with "
+    "we our you your they their which who what when where how can may also into than then there these those".split()
+)
+
+
+def tokenize(text):
+    """Splits text into lower-cased word tokens, without stopwords and single characters."""
+    return [token for token in re.findall(r'[a-z0-9]+', text.lower()) if len(token) > 1 and token not in _STOPWORDS]
+
+
+def _split_long_text(text, max_chars):
+    """
+    Splits text at paragraph boundaries into pieces of at most roughly max_chars.
+
+    Separators are kept, so the pieces add up to the original text and their
+    offsets stay exact.
+    """
+    parts = re.split(r'(\n{2,})', text)
+    # Each paragraph keeps the blank lines that follow it
+    paragraphs = [parts[i] + (parts[i + 1] if i + 1 < len(parts) else "") for i in range(0, len(parts), 2)]
+    pieces = []
+    current = ""
+    for paragraph in paragraphs:
+        if current.strip() and len(current) + len(paragraph) > max_chars:
+            pieces.append(current)
+            current = ""
+        current += paragraph
+    if current.strip() or not pieces:
+        pieces.append(current)
+    else:
+        pieces[-1] += current
+    return pieces
+
+
+def chunk_document(source, md_text, page_offsets, rules=None, repeated_lines=frozenset(), page_numbers=None):
+    """
+    Chunks extracted markdown by heading for retrieval.
+
+    Each chunk is compressed with the same rules as the full prompt text and
+    remembers the pages it spans, so the images on those pages can be sent
+    along with it.
+
+    Args:
+        source (str): The file name the text came from.
+        md_text (str): The extracted markdown text.
+        page_offsets (list): The offset at which each page starts in md_text.
+        rules (dict, optional): The prompt compression rules.
+        repeated_lines (frozenset, optional): Page headers and footers to strip.
+        page_numbers (list, optional): The document page number of each
+            extracted page, if only some pages were extracted.
+
+    Returns:
+        list: Dictionaries with the chunk 'source', 'title', compressed 'text',
+              estimated 'tokens' and first and last 'pages'.
+    """
+    chunks = []
+    edge_lines = find_page_edge_lines(md_text, page_offsets)
+    for section in split_sections(md_text, max_level=3):
+        section_text = md_text[section['start']:section['end']]
+        offset = section['start']
+        for piece in _split_long_text(section_text, CHUNK_MAX_CHARS):
+            text, _ = compress_markdown(piece, rules, repeated_lines, edge_lines, offset)
+            first_page = page_number_at(page_offsets, offset, page_numbers) if page_offsets else 1
+            offset += len(piece)
+            last_page = page_number_at(page_offsets, max(offset - 1, 0), page_numbers) if page_offsets else 1
+            if text.strip():
+                chunks.append({
+                    'source': source,
+                    'title': section['title'],
+                    'text': text,
+                    'tokens': estimate_tokens(text),
+                    'pages': (first_page, last_page),
+                })
+    return chunks
+
+
+def build_index(chunks):
+    """
+    Builds a BM25 index over chunks.
+
+    Term statistics are kept as per-term postings of NumPy arrays, so scoring
+    a query only touches the chunks that contain its terms.
+
+    Args:
+        chunks (list): Chunks from chunk_document, possibly from several files.
+
+    Returns:
+        dict: The 'chunks', per-term 'postings' of (chunk indexes, term
+              frequencies), the 'idf' of each term and the BM25 length
+              normalization ('length_norm') of each chunk.
+    """
+    import numpy as np
+
+    term_chunks = {}
+    doc_lengths = np.zeros(len(chunks), dtype=np.float32)
+    for i, chunk in enumerate(chunks):
+        counts = Counter(tokenize(f"{chunk['title']} {chunk['text']}"))
+        doc_lengths[i] = sum(counts.values())
+        for term, count in counts.items():
+            term_chunks.setdefault(term, ([], []))
+            term_chunks[term][0].append(i)
+            term_chunks[term][1].append(count)
+
+    postings = {
+        term: (np.array(indexes, dtype=np.int32), np.array(counts, dtype=np.float32))
+        for term, (indexes, counts) in term_chunks.items()
+    }
+    n = len(chunks)
+    idf = {term: math.log(1 + (n - len(indexes) + 0.5) / (len(indexes) + 0.5)) for term, (indexes, _) in postings.items()}
+    average_length = float(doc_lengths.mean()) if n else 0.0
+    length_norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / max(average_length, 1.0))
+    return {'chunks': chunks, 'postings': postings, 'idf': idf, 'length_norm': length_norm}
+
+
+def score_chunks(index, query):
+    """Returns the BM25 score of every chunk in the index for the query, as a NumPy array."""
+    import numpy as np
+
+    scores = np.zeros(len(index['chunks']), dtype=np.float32)
+    for term in set(tokenize(query)):
+        if term not in index['postings']:
+            continue
+        indexes, counts = index['postings'][term]
+        scores[indexes] += index['idf'][term] * counts * (BM25_K1 + 1) / (counts + index['length_norm'][indexes])
+    return scores
+
+
+def select_chunks(index, prompt_type, token_budget, top_k=None):
+    """
+    Selects the chunks most relevant to a prompt type within a token budget.
+
+    If every chunk fits within the budget, all of them are returned so small
+    documents are sent whole. Otherwise chunks are taken in order of BM25
+    score for the prompt type's query, earlier chunks first among equal
+    scores, until the budget or `top_k` is reached. Chunks that match none of
+    the query terms are left out, unless no chunk matches at all, in which
+    case chunks are taken from the start of the document.
+
+    Args:
+        index (dict): An index from build_index.
+        prompt_type (str): A key of prompts.RETRIEVAL_QUERIES.
+        token_budget (int): The maximum estimated tokens of selected text.
+        top_k (int, optional): The maximum number of chunks to select.
+
+    Returns:
+        list: The selected chunks, in document order.
+    """
+    chunks = index['chunks']
+    if sum(chunk['tokens'] for chunk in chunks) <= token_budget:
+        return list(chunks)
+
+    import numpy as np
+
+    scores = score_chunks(index, RETRIEVAL_QUERIES[prompt_type])
+    order = np.argsort(-scores, kind='stable')
+    if scores.any():
+        order = order[scores[order] > 0]
+    selected = []
+    used_tokens = 0
+    for i in order:
+        if top_k is not None and len(selected) >= top_k:
+            break
+        if used_tokens + chunks[i]['tokens'] > token_budget:
+            continue
+        selected.append(int(i))
+        used_tokens += chunks[i]['tokens']
+    return [chunks[i] for i in sorted(selected)]
+
+
+def format_chunks(chunks):
+    """Joins selected chunks into prompt text, labelling each with its source file and pages."""
+    parts = []
+    for chunk in chunks:
+        first_page, last_page = chunk['pages']
+        pages = f"p. {first_page}" if first_page == last_page else f"pp. {first_page}-{last_page}"
+        parts.append(f"[{chunk['source']}, {pages}]\n{chunk['text'].strip()}")
+    return "\n\n--- \n\n".join(parts)
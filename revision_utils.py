@@ -0,0 +1,171 @@
+# revision_utils.py
+import hashlib
+import re
+from extraction_utils import split_sections, page_number_at
+from compression_utils import normalize_line, is_page_number, find_page_edge_lines
+
+# Page separator lines, which change between revisions without the content changing
+_SEPARATOR_LINE = re.compile(r'^\s*-{3,}\s*$')
+
+# Adjacent sections are summarized together in chunks of about this size
+SUMMARY_CHUNK_TARGET_CHARS = 8000
+
+# Version markers stripped from file names so "plan_v6.pdf" and "plan v7.pdf"
+# are recognised as revisions of the same business plan.
+_VERSION_MARKER = re.compile(r'[\s_\-]+(?:v|ver|version|rev|revision)[\s_\-.]*\d+(?:\.\d+)*|\s*\(\d+\)|[\s_\-]+(?:final|draft)\b', re.IGNORECASE)
+
+
+def hash_file(file_bytes):
+    """Returns the SHA-256 hex digest of an uploaded file."""
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def hash_text(text, ignore_lines=frozenset(), edge_lines=frozenset(), offset=0):
+    """
+    Returns a short content hash of a piece of markdown.
+
+    Whitespace is collapsed, so re-flowed text does not count as a change.
+    Page numbers and lines whose normalized form is in `ignore_lines`
+    (repeated page headers and footers) are ignored at page edges, given by
+    the document offsets in `edge_lines` and the offset of `text` in the
+    document. Numbers in the body, such as prices, are part of the hash.
+    """
+    lines = []
+    line_offset = offset
+    for line in text.splitlines(keepends=True):
+        at_page_edge = line_offset in edge_lines
+        line_offset += len(line)
+        if _SEPARATOR_LINE.match(line):
+            continue
+        if at_page_edge and (is_page_number(line) or (ignore_lines and normalize_line(line) in ignore_lines)):
+            continue
+        lines.append(line)
+    normalized = " ".join(" ".join(lines).split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:16]
+
+
+def revision_base_name(file_name):
+    """Returns the file name without its extension and version markers, lower-cased."""
+    stem = re.sub(r'\.pdf$', '', file_name, flags=re.IGNORECASE)
+    return _VERSION_MARKER.sub('', stem).strip(' _-').lower()
+
+
+def build_fingerprint(md_text, page_offsets, ignore_lines=frozenset(), page_numbers=None):
+    """
+    Builds the page- and section-level hashes of an extracted document.
+
+    Args:
+        md_text (str): The extracted markdown text.
+        page_offsets (list): The offset at which each page starts in md_text.
+        ignore_lines (frozenset, optional): Normalized header and footer lines
+            to leave out of the hashes.
+        page_numbers (list, optional): The document page number of each
+            extracted page, if only some pages were extracted.
+
+    Returns:
+        dict: 'pages' holds one hash per extracted page and 'page_numbers'
+              their page numbers. 'sections' holds the sections from
+              split_sections, each with its 'hash', first 'page' and a 'key'
+              that stays stable across revisions.
+    """
+    edge_lines = find_page_edge_lines(md_text, page_offsets)
+    page_bounds = page_offsets + [len(md_text)]
+    pages = [hash_text(md_text[page_bounds[i]:page_bounds[i + 1]], ignore_lines, edge_lines, page_bounds[i])
+             for i in range(len(page_offsets))]
+
+    sections = []
+    seen_titles = {}
+    for section in split_sections(md_text):
+        # Repeated titles ("Overview" under several chapters) are told apart by occurrence.
+        occurrence = seen_titles.get(section['title'], 0)
+        seen_titles[section['title']] = occurrence + 1
+        section['key'] = f"{section['title']}#{occurrence}"
+        section['hash'] = hash_text(md_text[section['start']:section['end']], ignore_lines, edge_lines, section['start'])
+        section['page'] = page_number_at(page_offsets, section['start'], page_numbers) if page_offsets else 1
+        sections.append(section)
+
+    page_numbers = page_numbers or list(range(1, len(pages) + 1))
+    return {'pages': pages, 'page_numbers': page_numbers, 'sections': sections}
+
+
+def diff_fingerprints(old, new):
+    """
+    Compares the fingerprints of two versions of a document.
+
+    Returns:
+        dict: Section titles that were 'added', 'removed', 'changed' or left
+              'unchanged', and the 1-based numbers of the new version's pages
+              whose content did not appear in the old version ('pages_changed').
+    """
+    old_sections = {section['key']: section for section in old['sections']}
+    new_keys = {section['key'] for section in new['sections']}
+    changes = {'added': [], 'removed': [], 'changed': [], 'unchanged': []}
+
+    for section in new['sections']:
+        previous = old_sections.get(section['key'])
+        if previous is None:
+            changes['added'].append(section['title'])
+        elif previous['hash'] != section['hash']:
+            changes['changed'].append(section['title'])
+        else:
+            changes['unchanged'].append(section['title'])
+    changes['removed'] = [section['title'] for section in old['sections'] if section['key'] not in new_keys]
+
+    old_pages = set(old['pages'])
+    changes['pages_changed'] = [page for page, page_hash in zip(new['page_numbers'], new['pages']) if page_hash not in old_pages]
+    return changes
+
+
+def find_previous_version(files, file_name, uploaded_names):
+    """
+    Finds the processed file that an upload is a revision of.
+
+    A file with the same name is always a revision. A file with a different
+    name counts as one when both names only differ by version markers and the
+    older file is no longer in the uploader.
+
+    Returns:
+        str: The name of the previous version in `files`, or None.
+    """
+    if file_name in files:
+        return file_name
+    base_name = revision_base_name(file_name)
+    for name in files:
+        if name not in uploaded_names and revision_base_name(name) == base_name:
+            return name
+    return None
+
+
+def group_sections(sections, target_chars=SUMMARY_CHUNK_TARGET_CHARS):
+    """
+    Groups adjacent (hash, title, text) sections into chunks of about `target_chars`.
+
+    Besides at the target size, a chunk ends after a section whose hash is a
+    multiple of 4 once the chunk holds a third of the target. Since those
+    boundaries depend only on the sections' content, editing a section
+    usually regroups only its own chunk and the later chunks keep their keys.
+
+    Returns:
+        list: The (hash, title, text) of each chunk. A chunk of one section
+              keeps that section's hash; a larger chunk is keyed by the
+              hashes of its sections.
+    """
+    groups, current, size = [], [], 0
+    for section in sections:
+        current.append(section)
+        size += len(section[2])
+        if size >= target_chars or (size >= target_chars // 3 and int(section[0], 16) % 4 == 0):
+            groups.append(current)
+            current, size = [], 0
+    if current:
+        groups.append(current)
+
+    chunks = []
+    for group in groups:
+        if len(group) == 1:
+            chunks.append(group[0])
+            continue
+        group_hash = hashlib.sha256("".join(section_hash for section_hash, _, _ in group).encode("utf-8")).hexdigest()[:16]
+        title = f"{group[0][1]} – {group[-1][1]}"
+        chunks.append((group_hash, title, "\n\n".join(text for _, _, text in group)))
+    return chunks
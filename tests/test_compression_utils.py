@@ -0,0 +1,160 @@
+from compression_utils import (
+    DEFAULT_COMPRESSION_RULES,
+    compress_markdown,
+    find_page_edge_lines,
+    find_repeated_lines,
+    is_page_number,
+)
+
+
+def make_document(page_bodies):
+    """Builds markdown with a header, footer and page number on every page, and returns it with the page offsets."""
+    md_text, page_offsets = "", []
+    for number, page_body in enumerate(page_bodies, start=1):
+        page_offsets.append(len(md_text))
+        md_text += f"Acme Corp Business Plan\n\n{page_body}\n\nConfidential - do not distribute\n\n{number}\n\n"
+    return md_text, page_offsets
+
+
+TOPICS = ["Market", "Product", "Pricing", "Operations"]
+
+
+def body_lines(number):
+    topic = TOPICS[number - 1]
+    return "\n".join([
+        f"{topic} opens with an introduction.",
+        f"{topic} continues with some context.",
+        "Confidential - do not distribute",  # the footer text, quoted in the body
+        "Revenue reached 120 units per month.",
+        "42",
+        f"{topic} has another line of body text.",
+        f"{topic} closes with a conclusion.",
+    ])
+
+
+def compress_document(md_text, page_offsets, rules=None):
+    repeated_lines = find_repeated_lines(md_text, page_offsets)
+    edge_lines = find_page_edge_lines(md_text, page_offsets)
+    text, _ = compress_markdown(md_text, rules, repeated_lines, edge_lines)
+    return text
+
+
+# --- Page headers, footers and numbers ---
+
+def test_headers_footers_and_page_numbers_are_stripped_at_page_edges():
+    md_text, page_offsets = make_document([body_lines(number) for number in range(1, 5)])
+    text = compress_document(md_text, page_offsets)
+    lines = text.splitlines()
+    assert "Acme Corp Business Plan" not in lines
+    assert not any(line in {"1", "2", "3", "4"} for line in lines)
+    assert "Market opens with an introduction." in lines
+    assert "Operations closes with a conclusion." in lines
+
+
+def test_body_lines_matching_headers_or_page_numbers_are_kept():
+    md_text, page_offsets = make_document([body_lines(number) for number in range(1, 5)])
+    lines = compress_document(md_text, page_offsets).splitlines()
+    # Only the body copies of the footer and the bare number are left
+    assert lines.count("Confidential - do not distribute") == 4
+    assert lines.count("42") == 4
+
+
+def test_repeated_body_figure_is_kept():
+    md_text, page_offsets = make_document([body_lines(number) for number in range(1, 5)])
+    lines = compress_document(md_text, page_offsets).splitlines()
+    assert lines.count("Revenue reached 120 units per month.") == 4
+
+
+def test_headers_are_kept_when_the_rules_are_off():
+    md_text, page_offsets = make_document([body_lines(number) for number in range(1, 5)])
+    rules = {**DEFAULT_COMPRESSION_RULES, "repeated_lines": False, "page_numbers": False}
+    lines = compress_document(md_text, page_offsets, rules).splitlines()
+    assert lines.count("Acme Corp Business Plan") == 4
+    assert "3" in lines
+
+
+def test_edge_offsets_are_relative_to_the_whole_document():
+    md_text, page_offsets = make_document([body_lines(number) for number in range(1, 5)])
+    repeated_lines = find_repeated_lines(md_text, page_offsets)
+    edge_lines = find_page_edge_lines(md_text, page_offsets)
+    start = page_offsets[2]
+    text, _ = compress_markdown(md_text[start:page_offsets[3]], None, repeated_lines, edge_lines, start)
+    assert text.splitlines()[0] == "Pricing opens with an introduction."
+    assert "3" not in text.splitlines()
+
+
+def test_is_page_number():
+    for line in ["12", "Page 12", "page 3 of 40", "12 / 40", "- 7 -", "— 7 —"]:
+        assert is_page_number(line), line
+    for line in ["- 7", "12 months", "Revenue 120", "1. Introduction"]:
+        assert not is_page_number(line), line
+
+
+# --- Table of contents and appendix ---
+
+TOC_AND_APPENDIX = """# Table of Contents
+
+Introduction ........ 1
+Market ........ 2
+
+# Introduction
+
+We sell software.
+
+# Appendix A
+
+Detailed figures.
+
+## Appendix Data
+
+More figures.
+"""
+
+
+def test_toc_and_appendix_are_kept_by_default():
+    text, _ = compress_markdown(TOC_AND_APPENDIX)
+    assert "# Table of Contents" in text
+    assert "# Appendix A" in text
+    assert "More figures." in text
+
+
+def test_toc_is_dropped_when_its_rule_is_on():
+    text, _ = compress_markdown(TOC_AND_APPENDIX, {"drop_toc": True})
+    assert "Table of Contents" not in text
+    assert "Market ........ 2" not in text
+    assert "We sell software." in text
+    assert "# Appendix A" in text
+
+
+def test_untitled_dot_leader_run_is_dropped_with_the_toc_rule():
+    md_text = "Introduction ........ 1\nMarket ........ 2\nProduct ........ 3\n\nWe sell software.\n"
+    text, _ = compress_markdown(md_text, {"drop_toc": True})
+    assert text == "We sell software.\n"
+
+
+def test_appendix_and_its_subsections_are_dropped_when_its_rule_is_on():
+    text, _ = compress_markdown(TOC_AND_APPENDIX, {"drop_appendix": True})
+    assert "Appendix" not in text
+    assert "figures" not in text
+    assert "# Table of Contents" in text
+    assert "We sell software." in text
+
+
+# --- Tables and whitespace ---
+
+def test_table_padding_is_collapsed():
+    md_text = "|  Name   |   Revenue  |\n| :------ | ---------: |\n|  Acme   |   120      |\n|   |   |\n"
+    text, _ = compress_markdown(md_text)
+    assert text == "|Name|Revenue|\n|---|---|\n|Acme|120|\n"
+
+
+def test_table_padding_is_kept_when_its_rule_is_off():
+    md_text = "|  Name   |   Revenue  |\n"
+    text, _ = compress_markdown(md_text, {"table_padding": False, "whitespace": False})
+    assert text == md_text.rstrip("\n")
+
+
+def test_whitespace_is_collapsed_and_savings_are_reported():
+    text, stats = compress_markdown("Some    text   here.\n\n\n\n\nMore text.   \n")
+    assert text == "Some text here.\n\nMore text.\n"
+    assert stats["saved_tokens"] == stats["original_tokens"] - stats["compressed_tokens"] > 0
@@ -0,0 +1,334 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+import gemini_utils
+from gemini_utils import CircuitBreaker, GeminiClient, SharedRequestTimeoutError, SingleFlight, request_key
+
+
+class WaiterTrackingFuture(Future):
+    """A Future that counts the callers waiting on it, so tests can release the leader once they all wait."""
+
+    waiting = threading.Semaphore(0)
+
+    def result(self, timeout=None):
+        WaiterTrackingFuture.waiting.release()
+        return super().result(timeout)
+
+
+@pytest.fixture
+def tracked_futures(monkeypatch):
+    WaiterTrackingFuture.waiting = threading.Semaphore(0)
+    monkeypatch.setattr(gemini_utils, "Future", WaiterTrackingFuture)
+    return WaiterTrackingFuture
+
+
+def wait_for_waiters(count):
+    for _ in range(count):
+        assert WaiterTrackingFuture.waiting.acquire(timeout=5)
+
+
+def start_leader(flight, key, fn):
+    """Starts a leader call in a thread and returns its future once fn is running."""
+    started = threading.Event()
+
+    def run():
+        started.set()
+        return fn()
+
+    pool = ThreadPoolExecutor(max_workers=1)
+    leader = pool.submit(flight.do, key, run)
+    assert started.wait(timeout=5)
+    pool.shutdown(wait=False)
+    return leader
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+# --- SingleFlight ---
+
+def test_single_flight_runs_concurrent_identical_calls_once(tracked_futures):
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        release.wait(timeout=5)
+        return "result"
+
+    leader = start_leader(flight, "key", fn)
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        waiters = [pool.submit(flight.do, "key", fn) for _ in range(3)]
+        wait_for_waiters(3)
+        release.set()
+        assert [waiter.result(timeout=5) for waiter in waiters] == [("result", True)] * 3
+    assert leader.result(timeout=5) == ("result", False)
+    assert len(calls) == 1
+
+
+def test_single_flight_does_not_cache_finished_calls():
+    flight = SingleFlight()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        return len(calls)
+
+    assert flight.do("key", fn) == (1, False)
+    assert flight.do("key", fn) == (2, False)
+
+
+def test_single_flight_keeps_different_keys_apart():
+    flight = SingleFlight()
+    assert flight.do("a", lambda: "a") == ("a", False)
+    assert flight.do("b", lambda: "b") == ("b", False)
+
+
+def test_single_flight_fans_out_errors_and_clears_the_key(tracked_futures):
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def fail():
+        release.wait(timeout=5)
+        raise ValueError("quota exceeded")
+
+    leader = start_leader(flight, "key", fail)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        waiter = pool.submit(flight.do, "key", fail)
+        wait_for_waiters(1)
+        release.set()
+        with pytest.raises(ValueError, match="quota exceeded"):
+            waiter.result(timeout=5)
+    with pytest.raises(ValueError, match="quota exceeded"):
+        leader.result(timeout=5)
+
+    # The failed call is not remembered
+    assert flight.do("key", lambda: "retried") == ("retried", False)
+
+
+def test_single_flight_waiter_timeout_does_not_affect_the_leader():
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def slow():
+        release.wait(timeout=5)
+        return "result"
+
+    leader = start_leader(flight, "key", slow)
+    with pytest.raises(SharedRequestTimeoutError):
+        flight.do("key", slow, timeout=0.01)
+    release.set()
+    assert leader.result(timeout=5) == ("result", False)
+
+
+def test_single_flight_leader_timeout_reaches_waiters_as_a_plain_timeout(tracked_futures):
+    flight = SingleFlight()
+    release = threading.Event()
+
+    def times_out():
+        release.wait(timeout=5)
+        raise TimeoutError("request timed out")
+
+    leader = start_leader(flight, "key", times_out)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        waiter = pool.submit(flight.do, "key", times_out, 5)
+        wait_for_waiters(1)
+        release.set()
+        with pytest.raises(TimeoutError) as error:
+            waiter.result(timeout=5)
+    assert not isinstance(error.value, SharedRequestTimeoutError)
+    with pytest.raises(TimeoutError):
+        leader.result(timeout=5)
+
+
+# --- CircuitBreaker ---
+
+def open_breaker(breaker):
+    for _ in range(breaker.failure_threshold):
+        assert breaker.allow_request()
+        breaker.record_failure()
+
+
+def test_breaker_opens_after_consecutive_failures():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60, clock=clock)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.record_success()  # resets the count
+    breaker.record_failure()
+    breaker.record_failure()
+    assert breaker.allow_request()
+
+    breaker.record_failure()
+    assert not breaker.allow_request()
+    clock.now += 20
+    assert breaker.seconds_until_retry() == 40
+
+
+def test_breaker_lets_one_trial_through_after_the_reset_timeout():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60, clock=clock)
+    open_breaker(breaker)
+    clock.now += 59
+    assert not breaker.allow_request()
+    clock.now += 1
+    assert breaker.allow_request()
+    assert not breaker.allow_request()  # only one trial at a time
+
+
+def test_breaker_closes_after_a_successful_trial():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60, clock=clock)
+    open_breaker(breaker)
+    clock.now += 60
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.allow_request()
+    assert breaker.allow_request()
+    assert breaker.seconds_until_retry() == 0
+
+
+def test_breaker_reopens_after_a_failed_trial():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=5, reset_timeout=60, clock=clock)
+    open_breaker(breaker)
+    clock.now += 60
+    assert breaker.allow_request()
+    breaker.record_failure()
+    assert not breaker.allow_request()
+    assert breaker.seconds_until_retry() == 60
+
+
+def test_breaker_released_trial_lets_the_next_request_try():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60, clock=clock)
+    open_breaker(breaker)
+    clock.now += 60
+    assert breaker.allow_request()
+    # A non-retryable error says nothing about the API's health
+    breaker.release_trial()
+    assert breaker.allow_request()
+    assert not breaker.allow_request()
+
+
+# --- request_key ---
+
+def test_request_key_is_stable_for_identical_requests():
+    image = {"mime_type": "image/png", "data": b"\x89PNG data"}
+    assert request_key("model", ["prompt", "text", image]) == request_key("model", ["prompt", "text", dict(image)])
+
+
+def test_request_key_differs_by_model_part_content_and_order():
+    parts = ["prompt", "text", {"mime_type": "image/png", "data": b"one"}]
+    key = request_key("model", parts)
+    assert request_key("other-model", parts) != key
+    assert request_key("model", ["prompt", "other text", parts[2]]) != key
+    assert request_key("model", ["prompt", "text", {"mime_type": "image/png", "data": b"two"}]) != key
+    assert request_key("model", ["prompt", "text", {"mime_type": "image/jpeg", "data": b"one"}]) != key
+    assert request_key("model", ["text", "prompt", parts[2]]) != key
+
+
+def test_request_key_hashes_pil_images_by_content():
+    Image = pytest.importorskip("PIL.Image")
+    red = Image.new("RGB", (4, 4), (255, 0, 0))
+    assert request_key("model", ["prompt", red]) == request_key("model", ["prompt", red.copy()])
+    assert request_key("model", ["prompt", red]) != request_key("model", ["prompt", Image.new("RGB", (4, 4), (0, 0, 255))])
+
+
+# --- Hedging ---
+
+class Usage:
+    def __init__(self, prompt, total):
+        self.prompt_token_count = prompt
+        self.candidates_token_count = total - prompt
+        self.total_token_count = total
+
+
+class Response:
+    def __init__(self, text, total):
+        self.text = text
+        self.usage_metadata = Usage(10, total)
+
+
+class ScriptedClient(GeminiClient):
+    """A client whose calls block until released, numbered in the order they are sent."""
+
+    def __init__(self, hedge_after, **kwargs):
+        super().__init__(model_name="model", hedge_after=hedge_after, breaker=CircuitBreaker(5, 60), **kwargs)
+        self.lock = threading.Lock()
+        self.sent = []
+        self.releases = {}
+
+    def _call(self, prompt_parts, timeout):
+        with self.lock:
+            number = len(self.sent)
+            self.sent.append(prompt_parts[0])
+            release = self.releases.setdefault(number, threading.Event())
+        assert release.wait(timeout=5)
+        return Response(f"answer {number}", 20 + number)
+
+    def release(self, number):
+        with self.lock:
+            self.releases.setdefault(number, threading.Event()).set()
+
+
+def test_hedge_reports_the_losers_tokens():
+    reported = []
+    client = ScriptedClient(hedge_after=0.05, on_hedge_usage=reported.append)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        result = pool.submit(client.generate, ["prompt"])
+        deadline = time.monotonic() + 5
+        while len(client.sent) < 2 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        client.release(1)  # the hedge wins
+        text, token_info = result.result(timeout=5)
+    assert text == "answer 1"
+    assert token_info["total"] == 21
+
+    client.release(0)
+    deadline = time.monotonic() + 5
+    while not reported and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert reported == [{"prompt": 10, "output": 10, "total": 20}]
+
+
+def test_hedges_are_not_capped_by_a_worker_pool():
+    client = ScriptedClient(hedge_after=0.05)
+    requests = 12
+    with ThreadPoolExecutor(max_workers=requests) as pool:
+        results = [pool.submit(client.generate, [f"prompt {i}"]) for i in range(requests)]
+        deadline = time.monotonic() + 5
+        # Every primary and its hedge are sent, none waits for a free worker
+        while len(client.sent) < 2 * requests and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert len(client.sent) == 2 * requests
+        for number in range(2 * requests):
+            client.release(number)
+        assert all(result.result(timeout=5)[0].startswith("answer") for result in results)
+
+
+def test_no_hedge_when_the_call_answers_in_time():
+    client = ScriptedClient(hedge_after=5)
+    client.release(0)
+    assert client.generate(["prompt"])[0] == "answer 0"
+    assert client.sent == ["prompt"]
+
+
+# --- Token usage ---
+
+def test_token_info_bills_thinking_tokens_as_output():
+    response = Response("answer", 0)
+    response.usage_metadata.prompt_token_count = 100
+    response.usage_metadata.candidates_token_count = 40
+    response.usage_metadata.total_token_count = 540  # 400 thinking tokens
+    token_info = GeminiClient(model_name="model")._token_info(response, ["prompt"], "answer")
+    assert token_info == {"prompt": 100, "output": 440, "total": 540}
@@ -0,0 +1,109 @@
+from mermaid_utils import clean_label, repair_mermaid
+
+
+def body(repaired):
+    """Returns the statements of a repaired diagram without the header and indentation."""
+    return [line.strip() for line in repaired.splitlines()[1:]]
+
+
+# --- Edges ---
+
+def test_edge_text_between_arrow_halves_becomes_a_label():
+    repaired, problems = repair_mermaid("A -- calls --> B")
+    assert body(repaired) == ["A -->|calls| B"]
+    assert problems == []
+
+
+def test_edge_text_glued_to_the_node_ids():
+    repaired, problems = repair_mermaid("B-- calls -->C[X]")
+    assert body(repaired) == ["B -->|calls| C[X]"]
+    assert problems == []
+
+
+def test_duplicate_edges_are_dropped():
+    repaired, problems = repair_mermaid("A --> B\nA --> B\nA-->B\nA -->|other| B")
+    assert body(repaired) == ["A --> B", "A -->|other| B"]
+    assert problems == []
+
+
+def test_each_node_keeps_its_first_label():
+    repaired, _ = repair_mermaid("A[Client] --> B[API]\nA[Browser] --> C[DB]")
+    assert body(repaired) == ["A[Client] --> B[API]", "A --> C[DB]"]
+
+
+def test_unparseable_edge_is_reported():
+    repaired, problems = repair_mermaid("A --> B\nA -- > > B")
+    assert body(repaired) == ["A --> B"]
+    assert problems == ["Could not parse the line: A -- > > B"]
+
+
+# --- Labels and IDs ---
+
+def test_parentheses_and_brackets_are_removed_from_labels():
+    repaired, problems = repair_mermaid("A[User (web)] --> B[API [v2]]\nB -->|calls (REST)| C{Auth {OAuth}}")
+    assert body(repaired) == ["A[User web] --> B[API v2]", "B -->|calls REST| C{Auth OAuth}"]
+    assert problems == []
+
+
+def test_clean_label_collapses_whitespace():
+    assert clean_label('  Payment  "Gateway" (v2); ') == "Payment Gateway v2"
+
+
+def test_reserved_end_id_is_renamed():
+    repaired, problems = repair_mermaid("end[End] --> A[Start]\nA --> end")
+    assert body(repaired) == ["end_[End] --> A[Start]", "A --> end_"]
+    assert problems == []
+
+
+def test_node_ids_with_spaces_are_made_safe():
+    repaired, _ = repair_mermaid("User --> Payment Gateway")
+    assert body(repaired) == ["User --> Payment_Gateway[Payment Gateway]"]
+
+
+# --- Surrounding text ---
+
+def test_fences_and_prose_are_removed():
+    code = "Here is the diagram:\n```mermaid\ngraph LR\nA --> B\n```\nThis shows the flow."
+    repaired, problems = repair_mermaid(code)
+    assert repaired == "graph LR\n    A --> B"
+    assert problems == []
+
+
+def test_missing_header_is_added():
+    repaired, _ = repair_mermaid("A --> B")
+    assert repaired.splitlines()[0] == "graph TD"
+
+
+def test_style_statements_are_removed():
+    repaired, _ = repair_mermaid("A --> B\nclassDef red fill:#f00\nstyle A fill:#f00\nclass A red")
+    assert body(repaired) == ["A --> B"]
+
+
+# --- Subgraphs ---
+
+def test_unclosed_subgraphs_are_closed():
+    repaired, problems = repair_mermaid("subgraph Backend\nA --> B\nsubgraph Inner\nC --> D")
+    assert body(repaired) == [
+        "subgraph Backend[Backend]", "A --> B", "subgraph Inner[Inner]", "C --> D", "end", "end",
+    ]
+    assert problems == []
+
+
+def test_stray_end_lines_are_removed():
+    repaired, problems = repair_mermaid("subgraph Backend\nA --> B\nend\nend\nB --> C")
+    assert body(repaired) == ["subgraph Backend[Backend]", "A --> B", "end", "B --> C"]
+    assert problems == []
+
+
+# --- Problems ---
+
+def test_diagram_without_nodes_is_reported():
+    repaired, problems = repair_mermaid("The system is simple.")
+    assert repaired == "graph TD"
+    assert problems == ["The diagram contains no nodes or edges."]
+
+
+def test_node_definitions_alone_are_a_valid_diagram():
+    repaired, problems = repair_mermaid("A[Only node]")
+    assert body(repaired) == ["A[Only node]"]
+    assert problems == []
@@ -0,0 +1,77 @@
+import pytest
+
+pytest.importorskip("numpy")
+
+from retrieval_utils import _split_long_text, build_index, format_chunks, select_chunks
+
+
+def make_chunk(title, text, page):
+    return {"source": "plan.pdf", "title": title, "text": text, "tokens": 10, "pages": (page, page)}
+
+
+def titles(chunks):
+    return [chunk["title"] for chunk in chunks]
+
+
+# --- select_chunks ---
+
+def test_small_documents_are_sent_whole():
+    chunks = [make_chunk("Intro", "Nothing relevant here.", 1), make_chunk("Team", "Five engineers.", 2)]
+    assert select_chunks(build_index(chunks), "analysis", token_budget=100) == chunks
+
+
+def test_equal_scores_keep_the_earlier_chunks():
+    chunks = [make_chunk(f"Pricing {i}", "The pricing of the plan.", i) for i in range(1, 6)]
+    selected = select_chunks(build_index(chunks), "analysis", token_budget=20)
+    assert titles(selected) == ["Pricing 1", "Pricing 2"]
+
+
+def test_higher_scores_are_selected_first_and_returned_in_document_order():
+    chunks = [
+        make_chunk("Pricing", "The pricing of the plan.", 1),
+        make_chunk("Market", "Market analysis, competition and market risks.", 2),
+        make_chunk("Revenue", "Revenue and financial projections.", 3),
+    ]
+    selected = select_chunks(build_index(chunks), "analysis", token_budget=20)
+    assert titles(selected) == ["Market", "Revenue"]
+
+
+def test_chunks_without_matching_terms_are_skipped():
+    chunks = [
+        make_chunk("Garden", "Roses bloom in spring.", 1),
+        make_chunk("Pricing", "The pricing of the plan.", 2),
+        make_chunk("Weather", "It rained all week.", 3),
+    ]
+    selected = select_chunks(build_index(chunks), "analysis", token_budget=20)
+    assert titles(selected) == ["Pricing"]
+
+
+def test_document_order_is_used_when_nothing_matches():
+    chunks = [make_chunk(f"Garden {i}", "Roses bloom in spring.", i) for i in range(1, 5)]
+    selected = select_chunks(build_index(chunks), "analysis", token_budget=20)
+    assert titles(selected) == ["Garden 1", "Garden 2"]
+
+
+def test_top_k_limits_the_selection():
+    chunks = [make_chunk(f"Pricing {i}", "The pricing of the plan.", i) for i in range(1, 6)]
+    selected = select_chunks(build_index(chunks), "analysis", token_budget=40, top_k=1)
+    assert titles(selected) == ["Pricing 1"]
+
+
+def test_format_chunks_labels_sources_and_pages():
+    chunks = [make_chunk("Pricing", "The pricing.", 2), {**make_chunk("Team", "Engineers.", 3), "pages": (3, 4)}]
+    assert format_chunks(chunks) == "[plan.pdf, p. 2]\nThe pricing.\n\n--- \n\n[plan.pdf, pp. 3-4]\nEngineers."
+
+
+# --- _split_long_text ---
+
+def test_split_pieces_add_up_to_the_original_text():
+    text = "\n\n".join(f"Paragraph {i} " + "word " * 20 for i in range(10)) + "\n\n\n"
+    pieces = _split_long_text(text, 300)
+    assert len(pieces) > 1
+    assert "".join(pieces) == text
+    assert all(len(piece) <= 300 for piece in pieces[:-1])
+
+
+def test_short_text_is_one_piece():
+    assert _split_long_text("One paragraph.\n\nTwo.", 300) == ["One paragraph.\n\nTwo."]
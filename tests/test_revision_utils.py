@@ -0,0 +1,151 @@
+from compression_utils import find_repeated_lines
+from revision_utils import (
+    build_fingerprint,
+    diff_fingerprints,
+    find_previous_version,
+    group_sections,
+    revision_base_name,
+)
+
+SECTIONS = {
+    "Market": "The market is worth 40 million dollars.\nWe target small retailers.\nGrowth is steady.",
+    "Pricing": "The basic plan costs 20 dollars per month.\nThe pro plan adds reporting.\nDiscounts apply yearly.",
+    "Team": "The team has five engineers.\nTwo more join next year.\nHiring is remote.",
+}
+
+
+def make_document(sections, first_page_number=1):
+    """
+    Builds markdown with one section per page, each with a header and a printed
+    page number. The first header becomes a "Preamble" section.
+    """
+    md_text, page_offsets = "", []
+    for number, (title, text) in enumerate(sections.items(), start=first_page_number):
+        page_offsets.append(len(md_text))
+        md_text += f"Acme Corp Business Plan\n\n# {title}\n\n{text}\n\nPage {number} of 12\n\n"
+    return md_text, page_offsets
+
+
+def fingerprint(sections, first_page_number=1):
+    md_text, page_offsets = make_document(sections, first_page_number)
+    return build_fingerprint(md_text, page_offsets, find_repeated_lines(md_text, page_offsets))
+
+
+# --- Fingerprints ---
+
+def test_changed_body_number_marks_its_section_as_changed():
+    revised = {**SECTIONS, "Pricing": SECTIONS["Pricing"].replace("20 dollars", "25 dollars")}
+    changes = diff_fingerprints(fingerprint(SECTIONS), fingerprint(revised))
+    assert changes["changed"] == ["Pricing"]
+    assert changes["unchanged"] == ["Preamble", "Market", "Team"]
+    assert changes["added"] == changes["removed"] == []
+    assert changes["pages_changed"] == [2]
+
+
+def test_shifted_page_numbering_alone_changes_nothing():
+    changes = diff_fingerprints(fingerprint(SECTIONS), fingerprint(SECTIONS, first_page_number=3))
+    assert changes["changed"] == []
+    assert changes["unchanged"] == ["Preamble", "Market", "Pricing", "Team"]
+    assert changes["pages_changed"] == []
+
+
+def test_reflowed_text_is_not_a_change():
+    reflowed = {**SECTIONS, "Team": SECTIONS["Team"].replace("\n", " ").replace("five", "five ")}
+    changes = diff_fingerprints(fingerprint(SECTIONS), fingerprint(reflowed))
+    assert changes["changed"] == []
+
+
+def test_added_and_removed_sections():
+    revised = {"Market": SECTIONS["Market"], "Team": SECTIONS["Team"], "Risks": "Competition is strong.\nCosts may rise.\nRegulation changes."}
+    changes = diff_fingerprints(fingerprint(SECTIONS), fingerprint(revised))
+    assert changes["added"] == ["Risks"]
+    assert changes["removed"] == ["Pricing"]
+
+
+def test_repeated_titles_are_keyed_by_occurrence():
+    md_text = "# Product\n\n## Overview\n\nThe product.\n\n# Market\n\n## Overview\n\nThe market.\n"
+    sections = build_fingerprint(md_text, [0])["sections"]
+    assert [section["key"] for section in sections] == ["Product#0", "Overview#0", "Market#0", "Overview#1"]
+
+    revised = md_text.replace("The market.", "The market is large.")
+    changes = diff_fingerprints(build_fingerprint(md_text, [0]), build_fingerprint(revised, [0]))
+    # Only the second "Overview" changed
+    assert changes["changed"] == ["Overview"]
+    assert changes["unchanged"] == ["Product", "Overview", "Market"]
+
+
+def test_sections_record_their_document_page():
+    md_text, page_offsets = make_document(SECTIONS)
+    sections = build_fingerprint(md_text, page_offsets, page_numbers=[5, 6, 7])["sections"]
+    assert [(section["title"], section["page"]) for section in sections] == [
+        ("Preamble", 5), ("Market", 5), ("Pricing", 6), ("Team", 7),
+    ]
+
+
+# --- Versioned file names ---
+
+def test_revision_base_name_strips_version_markers():
+    assert revision_base_name("plan_v6.pdf") == "plan"
+    assert revision_base_name("plan v7.pdf") == "plan"
+    assert revision_base_name("Plan-Final.PDF") == "plan"
+    assert revision_base_name("plan (2).pdf") == "plan"
+    assert revision_base_name("plan_rev1.2.pdf") == "plan"
+    assert revision_base_name("marketing plan.pdf") == "marketing plan"
+
+
+def test_find_previous_version_pairs_versioned_names():
+    files = {"plan_v6.pdf": {}, "budget.pdf": {}}
+    assert find_previous_version(files, "plan v7.pdf", ["plan v7.pdf", "budget.pdf"]) == "plan_v6.pdf"
+
+
+def test_find_previous_version_keeps_files_still_in_the_uploader_apart():
+    files = {"plan_v6.pdf": {}}
+    assert find_previous_version(files, "plan v7.pdf", ["plan_v6.pdf", "plan v7.pdf"]) is None
+
+
+def test_find_previous_version_prefers_the_same_name():
+    files = {"plan_v6.pdf": {}, "plan v7.pdf": {}}
+    assert find_previous_version(files, "plan v7.pdf", ["plan v7.pdf"]) == "plan v7.pdf"
+
+
+def test_find_previous_version_ignores_other_documents():
+    assert find_previous_version({"budget.pdf": {}}, "plan.pdf", ["plan.pdf"]) is None
+
+
+# --- Summary chunks ---
+
+def section(number, size, boundary=False):
+    """A (hash, title, text) section whose hash is a multiple of 4 only if it is a content boundary."""
+    return (f"{number * 4 + (0 if boundary else 1):016x}", f"Section {number}", "x" * size)
+
+
+def test_small_sections_are_grouped_up_to_the_target():
+    sections = [section(number, 300) for number in range(10)]
+    chunks = group_sections(sections, target_chars=1000)
+    assert [title for _, title, _ in chunks] == ["Section 0 – Section 3", "Section 4 – Section 7", "Section 8 – Section 9"]
+    assert "".join(text for _, _, text in chunks).replace("\n\n", "") == "x" * 3000
+
+
+def test_single_section_chunks_keep_the_section_hash():
+    sections = [section(0, 2000), section(1, 300)]
+    chunks = group_sections(sections, target_chars=1000)
+    assert chunks[0] == sections[0]
+    assert chunks[1] == sections[1]
+
+
+def test_group_keys_depend_on_the_grouped_sections():
+    sections = [section(number, 300) for number in range(4)]
+    key = group_sections(sections, target_chars=1000)[0][0]
+    assert key not in {section_hash for section_hash, _, _ in sections}
+    changed = [sections[0], section(9, 300), *sections[2:]]
+    assert group_sections(changed, target_chars=1000)[0][0] != key
+
+
+def test_content_boundaries_keep_later_chunks_stable():
+    sections = [section(0, 300), section(1, 300, boundary=True), section(2, 300), section(3, 300), section(4, 300)]
+    chunks = group_sections(sections, target_chars=1000)
+    # A longer first section changes its own chunk, which still ends at the content boundary
+    edited = [(sections[0][0][:-1] + "9", sections[0][1], "x" * 500), *sections[1:]]
+    edited_chunks = group_sections(edited, target_chars=1000)
+    assert edited_chunks[0][0] != chunks[0][0]
+    assert edited_chunks[1:] == chunks[1:]
@@ -0,0 +1,62 @@
+import streamlit as st
+
+# Custom CSS to reduce vertical spacing for a more compact layout.
+# Kept at module level so the string is built once per process; Streamlit
+# still needs it emitted on every rerun for the styles to stay on the page.
+APP_CSS = """
+<style>
+    /* Main container adjustments */
+    .main .block-container {
+        padding-top: 2rem; /* A bit of space at the top */
+    }
+
+    /* Heading adjustments for compactness */
+    h1 {
+        margin-bottom: 0.5rem !important; /* Space after main title */
+    }
+    h2, h3 { /* Affects st.subheader and st.header */
+        margin-top: 2rem !important; /* Space before section headers */
+    }
+
+    /* Sidebar adjustments for compactness */
+    [data-testid="stSidebar"] div.stMarkdown {
+        padding-top: 0px !important;
+        padding-bottom: 0px !important;
+    }
+    [data-testid="stSidebar"] ul {
+        list-style-type: none;
+        padding-left: 0;
+    }
+    [data-testid="stSidebar"] h2 {
+        margin-top: 1rem; /* Space above section headers */
+        margin-bottom: 0.25rem; /* Reduce space after sidebar headers */
+    }
+    /* Custom style for the token display in the sidebar */
+    .sidebar-token-usage {
+        font-size: 0.9rem;
+        color: grey;
+        padding: 0px;
+        margin-bottom: 0.5rem; /* Reduced bottom margin */
+    }
+</style>
+"""
+
+
+def inject_css():
+    """Injects the app's custom CSS into the current page."""
+    st.markdown(APP_CSS, unsafe_allow_html=True)
+
+
+def render_mermaid(mermaid_code, key):
+    """
+    Renders a Mermaid diagram.
+
+    streamlit_mermaid registers a custom component on import, so it is only
+    imported once a diagram actually has to be displayed.
+
+    Args:
+        mermaid_code (str): The Mermaid.js code to render.
+        key (str): A unique Streamlit widget key for the diagram.
+    """
+    from streamlit_mermaid import st_mermaid
+    st_mermaid(mermaid_code, key=key)